@@ -0,0 +1,192 @@
+# Benchmarks each stage of seven_continents.py separately on a fixed sample of
+# the airports, so that two versions of the solver (or two search engines) can
+# be compared run for run. The sample and the search are seeded, and results
+# are written as JSON:
+#
+#	python benchmark.py --sample-size 2000 --output benchmark.json
+#
+# Any other arguments are passed through to the solver, e.g. --solver dp.
+
+import argparse
+import json
+import platform
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import seven_continents
+
+class Benchmark(object):
+
+	def __init__(self):
+		self.stages = []
+
+	def run(self, name, func, *args):
+		"""
+		Run func(*args) as the stage called name and record its wall time and the
+		peak RSS so far. func returns its result and a dict of extra metrics.
+		"""
+		print "Benchmarking %s..." % name
+		st = time.time()
+		result, metrics = func(*args)
+		stage = {
+			'name': name,
+			'wall_time_s': time.time() - st,
+			# ru_maxrss is in kB on Linux
+			'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+		}
+		stage.update(metrics)
+		self.stages.append(stage)
+		return result
+
+	def summary(self):
+		out = "%-16s %10s %10s  %s\n" % ('stage', 'time (s)', 'rss (MB)', 'metrics')
+		for stage in self.stages:
+			metrics = ', '.join('%s=%s' % (k, v) for k, v in sorted(stage.items()) if k not in ('name', 'wall_time_s', 'peak_rss_mb'))
+			out += "%-16s %10.3f %10.1f  %s\n" % (stage['name'], stage['wall_time_s'], stage['peak_rss_mb'], metrics)
+		return out
+
+def sample_snapshot(snapshot, size, rng, keep_ids=()):
+	"""
+	A snapshot (see seven_continents.load_airport_snapshot) with about size of
+	its airports, sampled separately for each continent in proportion to its
+	share of the airports so that every continent is still represented. Airports
+	in keep_ids are always kept.
+	"""
+	ids = snapshot['ids']
+	by_continent = {}
+	for i, continent in enumerate(snapshot['columns']['continent']):
+		by_continent.setdefault(continent, []).append(i)
+	selected = set(i for i in xrange(len(ids)) if ids[i] in keep_ids)
+	for continent in sorted(by_continent):
+		members = by_continent[continent]
+		count = min(len(members), max(1, int(round(size * float(len(members)) / len(ids)))))
+		selected.update(rng.sample(members, count))
+	selected = sorted(selected)
+	return {
+		'columns': dict((name, [values[i] for i in selected]) for name, values in snapshot['columns'].items()),
+		'ids': ids[selected],
+		'latitudes': snapshot['latitudes'][selected],
+		'longitudes': snapshot['longitudes'][selected],
+		'stats': snapshot['stats'],
+	}
+
+def bench_load_data(args):
+	return seven_continents.load_data(args), {}
+
+def bench_build_cache(prefix, data, args):
+	seven_continents.generate_dist_cache(prefix, data['all_airports'], args)
+	return None, {'airports': len(data['all_airports'])}
+
+def bench_load_cache(prefix, data, args):
+	return seven_continents.load_dist_cache(prefix, data['all_airports'], args), {}
+
+def bench_duration_cache(data, args):
+	return seven_continents.generate_duration_cache(data, args), {}
+
+def bench_setup_search(data, args):
+	return seven_continents.Search(data, args), {'buckets': len(data['hash_table'])}
+
+def bench_search(search):
+	st = time.time()
+	best_routes, search_count, valid_route_count = search.run_search()
+	elapsed = time.time() - st
+	metrics = {
+		'searches': search_count,
+		'valid_routes': valid_route_count,
+		'searches_per_s': search_count / elapsed if elapsed > 0 else 0.0,
+		'best_duration_hrs': best_routes[0].get_duration(search.data, search.args) if best_routes else None,
+	}
+	return (best_routes, search_count, valid_route_count), metrics
+
+def bench_optimize(search, routes, optimize):
+	st = time.time()
+	optimized_routes = []
+	count = 0
+	for route in routes:
+		optimized_route, evaluated = optimize(route)
+		optimized_routes.append(optimized_route)
+		count += evaluated
+	elapsed = time.time() - st
+	optimized_routes = search.sort_routes(optimized_routes)
+	metrics = {
+		'routes': len(routes),
+		'evaluated': count,
+		'evaluated_per_s': count / elapsed if elapsed > 0 else 0.0,
+		'best_duration_hrs': optimized_routes[0].get_duration(search.data, search.args) if optimized_routes else None,
+	}
+	return (optimized_routes, count), metrics
+
+def bench_report(data, args, results):
+	return seven_continents.generate_report(data, args, results), {}
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Benchmark the stages of the Seven Continents route solver')
+	parser.add_argument('--sample-size', action="store",
+						default=2000, type=int,
+						help="Number of airports to sample for the cache, search and optimization stages.")
+	parser.add_argument('--max-searches', action="store",
+						default=1000000, type=int,
+						help="Number of routes to search in the search stage.")
+	parser.add_argument('--seed', action="store",
+						default=0, type=int,
+						help="Seed for the airport sample and the search.")
+	parser.add_argument('--output', action="store",
+						default="benchmark.json",
+						help="File to write the results to, as JSON.")
+	bench_args, solver_argv = parser.parse_known_args()
+	args = seven_continents.parse_args(solver_argv + ['--max-searches', str(bench_args.max_searches), '--seed', str(bench_args.seed)])
+
+	benchmark = Benchmark()
+	data = benchmark.run('load_data', bench_load_data, args)
+	# The snapshot is keyed on the airport codes and ids as given, so it has to be
+	# loaded before the codes are converted
+	snapshot = seven_continents.load_airport_snapshot(args)
+	seven_continents.resolve_airport_codes(data, args)
+
+	# Everything else runs on a sample of the airports, with its own cache files
+	rng = random.Random(bench_args.seed)
+	snapshot = sample_snapshot(snapshot, bench_args.sample_size, rng, args.start_from_airport_ids)
+	data = seven_continents.build_data(snapshot, args)
+	prefix = tempfile.mkdtemp(prefix='seven_continents_benchmark')
+	try:
+		benchmark.run('cache_build', bench_build_cache, prefix, data, args)
+		data['dist_cache'] = benchmark.run('cache_load', bench_load_cache, prefix, data, args)
+		data['duration_cache'] = benchmark.run('duration_cache', bench_duration_cache, data, args)
+		search = benchmark.run('setup_search', bench_setup_search, data, args)
+		best_routes, search_count, valid_route_count = benchmark.run('search', bench_search, search)
+		benchmark.run('optimize_route', bench_optimize, search, best_routes,
+			lambda route: search.optimize_route(route, args.optimization_radius_mi, args.optimization_max_searches))
+		optimized_routes, optimize_count = benchmark.run('improve_route', bench_optimize, search, best_routes,
+			lambda route: search.improve_route(route, args.optimization_radius_mi))
+		results = {
+			'best_routes': optimized_routes,
+			'search_count': search_count,
+			'optimize_count': optimize_count,
+			'valid_route_count': valid_route_count,
+			'elapsed_time': sum(stage['wall_time_s'] for stage in benchmark.stages),
+		}
+		benchmark.run('report', bench_report, data, args, results)
+	finally:
+		shutil.rmtree(prefix, ignore_errors=True)
+
+	output = {
+		'seed': bench_args.seed,
+		'sample_size': bench_args.sample_size,
+		'airports': len(snapshot['ids']),
+		'max_searches': bench_args.max_searches,
+		'solver_args': solver_argv,
+		'python': platform.python_version(),
+		'numpy': np.__version__,
+		'created': time.time(),
+		'stages': benchmark.stages,
+	}
+	with open(bench_args.output, 'w') as outfile:
+		json.dump(output, outfile, indent=2, sort_keys=True)
+	print
+	print benchmark.summary()
+	print "Results written to %s" % bench_args.output
@@ -0,0 +1,74 @@
+# Timers and counters for a run of seven_continents.py. Events are written as a
+# stream of JSON lines (one object per line, each with the seconds since the
+# stream was opened in 't') when --metrics-file is given, and totals are kept
+# in memory either way and written as a final 'summary' event.
+#
+# This is module level state, like the logging module, so that the stages of
+# the solver can be instrumented without passing a metrics object around.
+
+import functools
+import json
+import time
+from contextlib import contextmanager
+
+counters = {}
+timers = {}
+outfile = None
+start_time = time.time()
+
+def open_stream(filepath):
+	global outfile, start_time
+	outfile = open(filepath, 'w')
+	start_time = time.time()
+
+def detach():
+	"""Stop writing events, e.g. in forked worker processes sharing the file"""
+	global outfile
+	outfile = None
+
+def emit(event, **fields):
+	if outfile is None:
+		return
+	fields['event'] = event
+	fields['t'] = round(time.time() - start_time, 6)
+	outfile.write(json.dumps(fields, sort_keys=True) + '\n')
+	outfile.flush()
+
+def count(name, value=1):
+	counters[name] = counters.get(name, 0) + value
+
+@contextmanager
+def timer(name):
+	"""Time a block, adding it to the totals for name and emitting a 'timer' event"""
+	st = time.time()
+	try:
+		yield
+	finally:
+		elapsed = time.time() - st
+		total, calls = timers.get(name, (0.0, 0))
+		timers[name] = (total + elapsed, calls + 1)
+		emit('timer', name=name, seconds=round(elapsed, 6))
+
+def timed(name):
+	"""Decorator version of timer"""
+	def decorator(func):
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			with timer(name):
+				return func(*args, **kwargs)
+		return wrapper
+	return decorator
+
+def summary():
+	return {
+		'counters': dict(counters),
+		'timers': dict((name, {'seconds': round(total, 6), 'calls': calls}) for name, (total, calls) in timers.items()),
+	}
+
+def close():
+	global outfile
+	if outfile is None:
+		return
+	emit('summary', **summary())
+	outfile.close()
+	outfile = None
@@ -4,28 +4,113 @@ import time
 import sys
 import urllib
 import argparse
-import math
 import struct
+import hashlib
+import os
+import signal
+import multiprocessing
+import heapq
+import cPickle
+import cProfile
+import pstats
+
+import numpy as np
 
 #from geopy.distance import distance as get_dist
 # This is roughly 15x faster although up to 0.5% off
 from geopy.distance import great_circle as dist_func
+from geopy.distance import EARTH_RADIUS
+from geopy import units
 
 import blacklist
+import metrics
 import planes
+import spatial
+
+# See generate_dist_cache for the layout of dist_cache.dat
+DIST_CACHE_MAGIC = 'SCDC'
+DIST_CACHE_VERSION = 2
+DIST_CACHE_HEADER = struct.Struct('<4sII20s20s')
+DIST_CACHE_BLOCK_ROWS = 256
+DIST_CACHE_BLOCK_TIMEOUT = 600
+SEARCH_WORKER_POLL = 1.0
+ADAPTIVE_HASH_MAX_DEPTH = 24
+SEQUENCE_BATCH_SIZE = 65536
+SEARCH_BATCH_SIZE = 65536
+# Share of the children in Search.breed that are crossed over, that have two
+# continents swapped, and that have a waypoint swapped for one in the same geo
+# hash bucket (the rest get any airport on the same continent)
+GENETIC_CROSSOVER_RATE = 0.5
+GENETIC_SWAP_RATE = 0.2
+GENETIC_LOCAL_RATE = 0.6
+PROFILE_PRINT_LINES = 25
+# See read_airport_snapshot for the layout of airport_snapshot.dat
+AIRPORT_SNAPSHOT_MAGIC = 'SCAS'
+AIRPORT_SNAPSHOT_VERSION = 1
+AIRPORT_SNAPSHOT_HEADER = struct.Struct('<4sI20s')
+AIRPORT_SNAPSHOT_SOURCES = ['runways.csv', 'supplemental_runways.csv', 'airports.csv', 'supplemental_airports.csv', 'countries.csv']
+# See read_checkpoint for the layout of --checkpoint-file
+CHECKPOINT_MAGIC = 'SCCK'
+CHECKPOINT_VERSION = 1
+CHECKPOINT_HEADER = struct.Struct('<4sI20s')
+# Metrics counters kept by the search loops, restored along with a checkpoint
+CHECKPOINT_COUNTERS = ('searches', 'valid_routes', 'dead_ends')
+# Max allowed difference between the vectorized distances and great_circle().mi
+DIST_TOLERANCE_MI = 0.01
+EARTH_RADIUS_MI = units.miles(kilometers=EARTH_RADIUS)
+
+# Filled in lazily by get_segments_by_speed
+segments_by_speed = {}
+
+class Airport(object):
+	"""
+	A valid airport. The fields used by the search are stored on the record
+	itself, already parsed. The rest of the csv row (name, links, etc.) stays in
+	the airport columns and is only looked up, through `details`, by the report.
+	"""
+	__slots__ = ('index', 'id', 'ident', 'type', 'continent', 'latitude', 'longitude', 'hash_key', 'columns')
+	
+	def __init__(self, index, id, ident, type, continent, latitude, longitude, columns):
+		self.index = index
+		self.id = id
+		self.ident = ident
+		self.type = type
+		self.continent = continent
+		self.latitude = latitude
+		self.longitude = longitude
+		self.hash_key = None
+		self.columns = columns
+		
+	def __repr__(self):
+		return "<Airport %s>" % self.ident
+		
+	@property
+	def details(self):
+		"""The full csv row, as a dict"""
+		return dict((name, values[self.index]) for name, values in self.columns.items())
 
 class Route(object):
-	segment_duration_cache = {}
+	"""
+	A route is a fixed length array of airport indices, i.e. rows / columns of
+	the distance and duration matrices. The Airport records are only looked up
+	when they're needed (see waypoints).
+	"""
 	
-	def __init__(self, waypoints=[]):
-		self.waypoints = waypoints
+	def __init__(self, indices, airports):
+		self.indices = np.array(indices, dtype=np.int32)
+		self.airports = airports
+		self.duration = None
 		
 	def __repr__(self):
-		return "<Route %s>" % ",".join([a['ident'] for a in self.waypoints])
+		return "<Route %s>" % ",".join([a.ident for a in self.waypoints])
+		
+	@property
+	def waypoints(self):
+		return [self.airports[index] for index in self.indices]
 		
 	def generate_coords(self):
 		"""Generate lat,long pairs for seq"""
-		return [airport['latitude_deg'] + ',' + airport['longitude_deg'] for airport in self.waypoints]
+		return ['%s,%s' % (airport.latitude, airport.longitude) for airport in self.waypoints]
 				
 	@staticmethod
 	def get_segment_length(waypoint1, waypoint2, data, args):
@@ -34,68 +119,155 @@ class Route(object):
 		
 	@staticmethod
 	def get_segment_duration(plane, waypoint1, waypoint2, data, args):
-		key = "%s:%s" % (waypoint1['id'], waypoint2['id'])
-		if key in Route.segment_duration_cache:
-			return Route.segment_duration_cache[key]
+		duration = data['duration_cache'][plane['avg_speed_mph']][waypoint1.index, waypoint2.index]
 		dist = Route.get_segment_length(waypoint1, waypoint2, data, args)
-		# Ensure duplicate waypoints are heavily penalized. This is needed due to some other bug...
 		if dist == 0.0:
 			dist = 9999.9
-		speed = plane['avg_speed_mph']
-		if not args.disable_jet_stream_correction:
-			lat1, long1 = float(waypoint1['latitude_deg']), float(waypoint1['longitude_deg'])
-			lat2, long2 = float(waypoint2['latitude_deg']), float(waypoint2['longitude_deg'])
-			lat_avg = (lat2 + lat1) / 2.0
-			long_delta = long2 - long1
-			src = (lat_avg, 0.0)
-			dst = (lat_avg, long_delta)
-			eastbound_dist = dist_func(src, dst).mi * (1.0 + args.routing_overhead_pct / 100.0)
-			# Due to spherical shape of earth, possible for this calculation to go unstable
-			if eastbound_dist >= dist:
-				eastbound_dist = dist - 1.0
-			if long_delta < 0.0:
-				eastbound_dist *= -1
-			radians = math.acos(eastbound_dist / dist)
-			speed += args.jet_stream_correction_mph * math.cos(radians)
-		duration = dist / speed
-		Route.segment_duration_cache[key] = (speed, duration)
+		speed = dist / duration
 		return (speed, duration)
 		
-	@staticmethod
-	def valid_segment(plane, waypoint1, waypoint2, data, args):
-		if Route.get_segment_length(waypoint1, waypoint2, data, args) < plane['max_range_mi']:
-			return True
-		else:
-			return False
-		
 	def get_length(self, data, args):
 		"""Calcuate travel distance between the sequence of waypoints"""
 		dist = 0.0
-		for i in range(len(self.waypoints) - 1):
-			dist += Route.get_segment_length(self.waypoints[i], self.waypoints[i + 1], data, args)
+		waypoints = self.waypoints
+		for i in range(len(waypoints) - 1):
+			dist += Route.get_segment_length(waypoints[i], waypoints[i + 1], data, args)
 		return dist
 		
 	def get_duration(self, data, args):
-		dur = 0.0
-		for i in range(len(self.waypoints) - 1):
-			plane = get_plane(i + 1)
-			speed, duration = Route.get_segment_duration(plane, self.waypoints[i], self.waypoints[i + 1], data, args)
-			dur += duration
-		return dur
+		if self.duration is None:
+			self.duration = get_route_durations(self.indices[np.newaxis], data)[0]
+		return self.duration
+		
+	def get_key(self):
+		return self.indices.tostring()
+		
+class BestRoutes(object):
+	"""
+	The best `size` distinct routes seen so far. They are kept in a max-heap 
+	keyed on duration, so a route slower than the current worst is rejected 
+	without touching the rest.
+	"""
+	
+	def __init__(self, size, data, args):
+		self.size = size
+		self.data = data
+		self.args = args
+		self.heap = []
+		self.keys = set()
 		
-	def set_waypoints(self, waypoints):
-		self.waypoints = waypoints
+	def __len__(self):
+		return len(self.heap)
+		
+	def add(self, route):
+		"""Returns True if the route made it into the best routes"""
+		duration = route.get_duration(self.data, self.args)
+		if len(self.heap) >= self.size and duration >= -self.heap[0][0]:
+			return False
+		key = route.get_key()
+		if key in self.keys:
+			return False
+		entry = (-duration, key, route)
+		if len(self.heap) < self.size:
+			heapq.heappush(self.heap, entry)
+		else:
+			removed = heapq.heapreplace(self.heap, entry)
+			self.keys.discard(removed[1])
+		self.keys.add(key)
+		return True
+		
+	def add_batch(self, routes, durations):
+		"""
+		Add a batch of routes (see get_route_durations), fastest first, stopping
+		once the rest are slower than the current worst.
+		"""
+		if len(self.heap) >= self.size:
+			faster = durations < -self.heap[0][0]
+			routes, durations = routes[faster], durations[faster]
+		for i in np.argsort(durations, kind='mergesort'):
+			if len(self.heap) >= self.size and durations[i] >= -self.heap[0][0]:
+				break
+			route = Route(routes[i], self.data['all_airports'])
+			route.duration = durations[i]
+			self.add(route)
+		
+	def get_best_duration(self):
+		if len(self.heap) == 0:
+			return 0.0
+		return -max(self.heap)[0]
+		
+	def get_routes(self):
+		"""Routes sorted from best to worst"""
+		return [route for duration, key, route in sorted(self.heap, reverse=True)]
+		
+class StopCondition(object):
+	"""
+	Decides when a search has run long enough, besides max_searches: once the
+	deadline (if any) has passed, or once the best duration hasn't improved by
+	more than args.convergence_pct percent over the last 
+	args.convergence_searches searches (if set).
+	"""
+	
+	def __init__(self, args, deadline):
+		self.deadline = deadline
+		self.window = args.convergence_searches
+		self.min_improvement = args.convergence_pct / 100.0
+		self.reference_duration = None
+		self.reference_count = 0
+		self.reason = None
+		
+	def should_stop(self, search_count, best_duration):
+		if self.deadline is not None and time.time() >= self.deadline:
+			self.reason = "time budget reached"
+			return True
+		if self.window:
+			if best_duration > 0 and (self.reference_duration is None or best_duration < self.reference_duration * (1.0 - self.min_improvement)):
+				self.reference_duration = best_duration
+				self.reference_count = search_count
+			elif search_count - self.reference_count >= self.window:
+				self.reason = "converged, less than %.2f%% better in the last %i searches" % (self.min_improvement * 100.0, self.window)
+				return True
+		return False
 		
 def get_plane(seg_num):
 	plane_name = planes.plane_to_segment[seg_num]
 	return planes.planes[plane_name]
 		
+def get_route_durations(routes, data):
+	"""
+	Durations of a batch of routes, given as a 2D array of airport indices with
+	one row per route. Each segment is a single gather over the whole batch.
+	"""
+	durations = np.zeros(len(routes))
+	for speed, seg_nums in get_segments_by_speed(routes.shape[1]):
+		durations += data['duration_cache'][speed][routes[:, seg_nums - 1], routes[:, seg_nums]].sum(axis=1)
+	return durations
+	
+def get_segments_by_speed(num_waypoints):
+	"""
+	The segment numbers of a route with num_waypoints waypoints, grouped by plane
+	speed, so that get_route_durations does one gather per distinct speed.
+	"""
+	if num_waypoints not in segments_by_speed:
+		groups = {}
+		for seg_num in range(1, num_waypoints):
+			groups.setdefault(get_plane(seg_num)['avg_speed_mph'], []).append(seg_num)
+		segments_by_speed[num_waypoints] = [(speed, np.array(seg_nums)) for speed, seg_nums in groups.items()]
+	return segments_by_speed[num_waypoints]
+	
+def get_valid_routes(routes, data, args):
+	"""Mask of the routes in a batch (see get_route_durations) that are within range on every segment"""
+	overhead = 1.0 + args.routing_overhead_pct / 100.0
+	valid = np.ones(len(routes), dtype=bool)
+	for seg_num in range(1, routes.shape[1]):
+		lengths = data['dist_cache'][routes[:, seg_num - 1], routes[:, seg_num]] * overhead
+		valid &= lengths < get_plane(seg_num)['max_range_mi']
+	return valid
+		
 def hash_airport(geo_hash_resolution, airport):
-	latitude = float(airport['latitude_deg']) 
-	longitude = float(airport['longitude_deg'])
 	# Using floored division
-	lat_bucket = (latitude + 90) // geo_hash_resolution
-	long_bucket = (longitude + 180) // geo_hash_resolution
+	lat_bucket = (airport.latitude + 90) // geo_hash_resolution
+	long_bucket = (airport.longitude + 180) // geo_hash_resolution
 	hash_key = '%s:%s' % (lat_bucket, long_bucket)
 	return hash_key
 	
@@ -106,200 +278,512 @@ def generate_geo_hash_table(geo_hash_resolution, airports):
 	for airport in airports:
 		hash_key = hash_airport(geo_hash_resolution, airport)
 		table[hash_key] = table.get(hash_key, []) + [airport]
-		airport['hash_key'] = hash_key
+		airport.hash_key = hash_key
 	return table
 
-def generate_dist_cache(prefix, airports):
+def generate_adaptive_hash_table(budget, airports):
+	"""
+	Partition the airports of each continent into at most `budget` cells with a
+	quadtree, always splitting the cell that holds the most airports next. Cells
+	are split in equal-area coordinates (longitude, sin(latitude)), so a cell near
+	the poles covers as much ground as one at the equator. Dense regions end up
+	with many small cells and sparse ones with a few large cells.
+	"""
+	table = {}
+	airports_by_continent = {}
+	for airport in airports:
+		airports_by_continent.setdefault(airport.continent, []).append(airport)
+	for cont, members in airports_by_continent.items():
+		x = np.array([airport.longitude for airport in members])
+		y = np.sin(np.radians([airport.latitude for airport in members]))
+		# Heap of (-num airports, quadtree path, bounds, positions in members)
+		cells = [(-len(members), '', (-180.0, 180.0, -1.0, 1.0), np.arange(len(members)))]
+		done = []
+		while cells:
+			cell = heapq.heappop(cells)
+			count, path, (x0, x1, y0, y1), positions = cell
+			xm, ym = (x0 + x1) / 2.0, (y0 + y1) / 2.0
+			quadrants = 2 * (y[positions] >= ym) + (x[positions] >= xm)
+			children = [(q, positions[quadrants == q]) for q in range(4)]
+			children = [(q, child) for q, child in children if len(child) > 0]
+			if -count <= 1 or len(path) >= ADAPTIVE_HASH_MAX_DEPTH or len(cells) + len(done) + len(children) > budget:
+				done.append(cell)
+				continue
+			for q, child in children:
+				bounds = (xm if q & 1 else x0, x1 if q & 1 else xm, ym if q & 2 else y0, y1 if q & 2 else ym)
+				heapq.heappush(cells, (-len(child), path + str(q), bounds, child))
+		for count, path, bounds, positions in done:
+			hash_key = '%s:%s' % (cont, path)
+			table[hash_key] = [members[i] for i in positions]
+			for airport in table[hash_key]:
+				airport.hash_key = hash_key
+	return table
+
+def filter_settings_hash(args):
+	"""Hash of every setting that decides which airports end up in the cache"""
+	settings = [
+		sorted(blacklist.COUNTRY_BLACKLIST),
+		sorted(blacklist.AIRPORT_BLACKLIST),
+		sorted(blacklist.ISO_REGION_BLACKLIST),
+		sorted(blacklist.GEO_OVERRIDES),
+		get_plane(1)['min_runway_length_ft'],
+		args.disable_geo_overrides,
+	]
+	return hashlib.sha1(repr(settings)).digest()
+
+def airport_ids_hash(ids):
+	return hashlib.sha1(ids.astype('<i4').tostring()).digest()
+
+def read_dist_cache_header(filepath):
+	"""
+	Returns the header of a cache file as a dict, or None if the file is missing
+	or was written with an older version of the protocol.
+	"""
+	try:
+		with open(filepath, 'rb') as cachefile:
+			header = cachefile.read(DIST_CACHE_HEADER.size)
+			if len(header) < DIST_CACHE_HEADER.size:
+				return None
+			magic, version, count, ids_hash, settings_hash = DIST_CACHE_HEADER.unpack(header)
+			if magic != DIST_CACHE_MAGIC or version != DIST_CACHE_VERSION:
+				return None
+			ids = np.frombuffer(cachefile.read(4 * count), dtype='<i4')
+	except IOError:
+		return None
+	return {
+		'count': count,
+		'ids_hash': ids_hash,
+		'settings_hash': settings_hash,
+		'ids': ids,
+		'offset': DIST_CACHE_HEADER.size + 4 * count,
+	}
+
+@metrics.timed('generate_dist_cache')
+def generate_dist_cache(prefix, airports, args):
 	"""
-	This code is kind of ugly. It implements a custom binary protocol which is 
-	faster than loading the cache via cPickle or using the json library. It's also
-	about 1/6th the size of a json file and 1/10 as large as a cPickle file.
+	The cache is a header followed by a raw float32 matrix, so it can be loaded
+	with np.memmap instead of being parsed.
 	
 	The protocol is:
-		2 bytes - num of entries
-		for each entry:
-			4 bytes (int) - ASCII version of airport ident
-			2 bytes (int) - num of distance values
-			for each distance value:
-				4 bytes (int) - ASCII version of second airport ident
-				4 bytes (float) - distance
+		4 bytes - magic ('SCDC')
+		4 bytes (uint) - protocol version
+		4 bytes (uint) - num of airports (N)
+		20 bytes - sha1 of the airport id list
+		20 bytes - sha1 of the filter settings (see filter_settings_hash)
+		N * 4 bytes (int) - airport id for each row / column
+		N * N * 4 bytes (float) - distance matrix, row major
 	"""
 	filepath = '%s/dist_cache.dat' % prefix
-	dist_cache = {}
-	entries = 0
-	try:
-		with open(filepath, 'rb', 65536) as cachefile:
-			entries = struct.unpack('h', cachefile.read(2))[0]
-	except:
-		pass
-	if entries < len(airports):
-		rebuild = raw_input("Cache is missing entries (%i vs %i), do you want to rebuild (y/n)? " % (entries, len(airports)))
-		if rebuild.lower() != 'y':
-			return
-		dist_cache = {}
+	ids = np.array([airport.id for airport in airports], dtype='<i4')
+	ids_hash = airport_ids_hash(ids)
+	settings_hash = filter_settings_hash(args)
+	header = read_dist_cache_header(filepath)
+	if header is not None and header['ids_hash'] == ids_hash and header['settings_hash'] == settings_hash:
+		return
+	if header is None:
+		print "No usable distance cache found, building one for %i airports..." % len(airports)
+	else:
+		print "Distance cache is stale (%i vs %i airports or filters changed), rebuilding..." % (header['count'], len(airports))
+	st = time.time()
+	count = len(airports)
+	tmp_filepath = filepath + '.tmp'
+	progress_filepath = filepath + '.progress'
+	offset = DIST_CACHE_HEADER.size + 4 * count
+	blocks = [(start, min(start + DIST_CACHE_BLOCK_ROWS, count)) for start in xrange(0, count, DIST_CACHE_BLOCK_ROWS)]
+	completed = set()
+	tmp_header = read_dist_cache_header(tmp_filepath)
+	if tmp_header is not None and tmp_header['ids_hash'] == ids_hash and tmp_header['settings_hash'] == settings_hash:
 		try:
-			dist_cache = load_dist_cache(prefix, airports)
-		except:
+			with open(progress_filepath, 'r') as progressfile:
+				completed = set(int(line) for line in progressfile if line.strip())
+		except IOError:
 			pass
-		print 'Rebuilding...'
-		try:
-			last_update = time.time()
-			for i, src in enumerate(airports):
-				if src['id'] in dist_cache and len(dist_cache[src['id']]) == len(airports):
-					continue
-				dists = {}
-				for dst in airports:
-					dist = get_dist(src, dst)
-					dists[dst['id']] = dist
-				dist_cache[src['id']] = dists
+		print "Resuming from checkpoint, %i of %i blocks already complete" % (len(completed), len(blocks))
+	else:
+		with open(tmp_filepath, 'wb') as cachefile:
+			cachefile.write(DIST_CACHE_HEADER.pack(DIST_CACHE_MAGIC, DIST_CACHE_VERSION, count, ids_hash, settings_hash))
+			cachefile.write(ids.tostring())
+			cachefile.truncate(offset + 4 * count * count)
+		open(progress_filepath, 'w').close()
+	remaining = [block for block in blocks if block[0] not in completed]
+	lats, longs = get_coord_arrays(airports)
+	workers = args.cache_workers or multiprocessing.cpu_count()
+	pool = None
+	try:
+		dist_cache = np.memmap(tmp_filepath, dtype='<f4', mode='r+', offset=offset, shape=(count, count))
+		if workers > 1 and len(remaining) > 1:
+			print "Using %i workers" % workers
+			pool = multiprocessing.Pool(workers, init_dist_worker, (lats, longs))
+			results = pool.imap_unordered(dist_worker, remaining)
+		else:
+			results = ((start, stop, get_dist_block(lats, longs, start, stop)) for start, stop in remaining)
+		last_update = time.time()
+		with open(progress_filepath, 'a') as progressfile:
+			for i in xrange(len(remaining)):
+				if pool:
+					# Wait with a timeout so that ctrl-c is delivered under Python 2
+					start, stop, block = results.next(DIST_CACHE_BLOCK_TIMEOUT)
+				else:
+					start, stop, block = results.next()
+				dist_cache[start:stop] = block
+				# Only record a block once its rows are safely on disk
+				dist_cache.flush()
+				progressfile.write('%i\n' % start)
+				progressfile.flush()
+				completed.add(start)
 				if time.time() - last_update > 5.0:
 					last_update = time.time()
-					pct = float(i) / len(airports) * 100.0
+					pct = float(len(completed)) / len(blocks) * 100.0
 					print "\t%.2f%% complete" % pct
-		except KeyboardInterrupt:
-			pass
-		print "Writing cache to file..."
-		st = time.time()
-		with open(filepath, 'w') as cachefile:
-			cachefile.write(struct.pack('h', len(dist_cache.keys())))
-			for key, val in dist_cache.items():
-				out = struct.pack('ih', int(key), len(val.keys()))
-				fmt = 'if' * len(val.keys())
-				args = []
-				[args.extend((int(k), v)) for k, v in val.items()]
-				out += struct.pack(fmt, *args)
-				cachefile.write(out)
-		print "Done (%.2fs)" % (time.time() - st)
-		dist_cache = {}
-
-def load_dist_cache(prefix, airports):
+		check_dist_cache(dist_cache, airports)
+		del dist_cache
+	except KeyboardInterrupt:
+		print "Interrupted, %i of %i blocks complete. Run again to resume." % (len(completed), len(blocks))
+		raise
+	finally:
+		if pool:
+			pool.terminate()
+			pool.join()
+	os.rename(tmp_filepath, filepath)
+	os.remove(progress_filepath)
+	print "Done (%.2fs)" % (time.time() - st)
+
+def init_dist_worker(lats, longs):
+	global dist_worker_coords
+	# Leave ctrl-c to the parent, which keeps the checkpoint consistent
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	dist_worker_coords = (lats, longs)
+
+def dist_worker(block):
+	start, stop = block
+	lats, longs = dist_worker_coords
+	return start, stop, get_dist_block(lats, longs, start, stop)
+
+@metrics.timed('load_dist_cache')
+def load_dist_cache(prefix, airports, args):
+	"""
+	Memory-map the cache as a dense float32 matrix indexed by airport.index.
+	"""
 	filepath = '%s/dist_cache.dat' % prefix
-	dist_cache = {}
 	st = time.time()
-	ids = [airport['id'] for airport in airports]
-	with open(filepath, 'rb', 65536) as cachefile:
-		print "Loading distance cache..."
-		entries = struct.unpack('h', cachefile.read(2))[0]
-		for i in xrange(entries):
-			src, dist_count = struct.unpack('ih', cachefile.read(6))
-			results = struct.unpack('if' * dist_count, cachefile.read(8 * dist_count))
-			if str(src) in ids:
-				dist_cache[str(src)] = dict(zip([str(dst) for dst in results[::2]], results[1::2]))
-	cached = len(dist_cache.keys())
-	print "Loaded distance cache in %.2fs, found %i entries." % (time.time() - st, cached)
+	header = read_dist_cache_header(filepath)
+	ids = np.array([airport.id for airport in airports], dtype='<i4')
+	if header is None or header['ids_hash'] != airport_ids_hash(ids) or header['settings_hash'] != filter_settings_hash(args):
+		raise ValueError("Distance cache %s is missing or stale" % filepath)
+	count = header['count']
+	dist_cache = np.memmap(filepath, dtype='<f4', mode='r', offset=header['offset'], shape=(count, count))
+	print "Loaded distance cache in %.2fs, found %i entries." % (time.time() - st, count)
 	return dist_cache
 	
+def get_coord_arrays(airports):
+	"""Latitudes and longitudes of airports, in radians"""
+	lats = np.radians(np.array([airport.latitude for airport in airports]))
+	longs = np.radians(np.array([airport.longitude for airport in airports]))
+	return lats, longs
+
+def get_dist_block(lats, longs, start, stop):
+	"""
+	Distances from airports start:stop to every airport, as a float32 block of
+	rows of the distance matrix. This is the same formula and earth radius that
+	great_circle uses, so results agree with get_dist to within DIST_TOLERANCE_MI.
+	"""
+	delta_long = longs[np.newaxis, :] - longs[start:stop, np.newaxis]
+	return get_great_circle_mi(lats[start:stop, np.newaxis], lats[np.newaxis, :], delta_long).astype(np.float32)
+
+def get_great_circle_mi(lat1, lat2, delta_long):
+	"""Vectorized great_circle(...).mi, takes (broadcastable) arrays in radians"""
+	sin_lat1, cos_lat1 = np.sin(lat1), np.cos(lat1)
+	sin_lat2, cos_lat2 = np.sin(lat2), np.cos(lat2)
+	cos_delta_long, sin_delta_long = np.cos(delta_long), np.sin(delta_long)
+	d = np.arctan2(
+		np.sqrt((cos_lat2 * sin_delta_long) ** 2 + (cos_lat1 * sin_lat2 - sin_lat1 * cos_lat2 * cos_delta_long) ** 2),
+		sin_lat1 * sin_lat2 + cos_lat1 * cos_lat2 * cos_delta_long)
+	return EARTH_RADIUS_MI * d
+
+def check_dist_cache(dist_cache, airports, samples=100):
+	"""Spot check random entries of the cache against geopy"""
+	for _ in range(samples):
+		src, dst = random.choice(airports), random.choice(airports)
+		expected = get_dist(src, dst)
+		if abs(dist_cache[src.index, dst.index] - expected) > DIST_TOLERANCE_MI:
+			print "warning: cached distance from %s to %s is %.4f mi, expected %.4f mi" % (src.ident, dst.ident, dist_cache[src.index, dst.index], expected)
+
+@metrics.timed('generate_duration_cache')
+def generate_duration_cache(data, args):
+	"""
+	Segment durations between every pair of airports, with routing overhead and
+	jet stream correction applied. Plane speed is the only plane setting that 
+	affects duration, so there is one float32 matrix per distinct avg_speed_mph
+	in planes.plane_to_segment.
+	"""
+	st = time.time()
+	dist_cache = data['dist_cache']
+	lats, longs = np.radians(data['latitudes']), np.radians(data['longitudes'])
+	count = len(lats)
+	overhead = 1.0 + args.routing_overhead_pct / 100.0
+	speeds = set(get_plane(seg_num)['avg_speed_mph'] for seg_num in planes.plane_to_segment)
+	duration_cache = dict((speed, np.empty((count, count), dtype=np.float32)) for speed in speeds)
+	for start in xrange(0, count, DIST_CACHE_BLOCK_ROWS):
+		stop = min(start + DIST_CACHE_BLOCK_ROWS, count)
+		dist = dist_cache[start:stop] * overhead
+		# Ensure duplicate waypoints are heavily penalized. This is needed due to some other bug...
+		dist[dist == 0.0] = 9999.9
+		eastbound_pct = 0.0
+		if not args.disable_jet_stream_correction:
+			lat_avg = (lats[start:stop, np.newaxis] + lats[np.newaxis, :]) / 2.0
+			long_delta = longs[np.newaxis, :] - longs[start:stop, np.newaxis]
+			eastbound_dist = get_great_circle_mi(lat_avg, lat_avg, long_delta) * overhead
+			# Due to spherical shape of earth, possible for this calculation to go unstable
+			eastbound_dist = np.where(eastbound_dist >= dist, dist - 1.0, eastbound_dist)
+			eastbound_dist[long_delta < 0.0] *= -1
+			eastbound_pct = np.clip(eastbound_dist / dist, -1.0, 1.0)
+		for speed, durations in duration_cache.items():
+			durations[start:stop] = dist / (speed + args.jet_stream_correction_mph * eastbound_pct)
+	print "Generated segment durations for %i plane speed(s) in %.2fs" % (len(speeds), time.time() - st)
+	return duration_cache
+
 def get_dist(src, dst):
-	src_coords = (src['latitude_deg'], src['longitude_deg'])
-	dst_coords = (dst['latitude_deg'], dst['longitude_deg'])
+	src_coords = (src.latitude, src.longitude)
+	dst_coords = (dst.latitude, dst.longitude)
 	dist = dist_func(src_coords, dst_coords).mi
 	return dist
 	
 def get_dist_from_cache(dist_cache, src, dst):
-	if src['id'] in dist_cache and dst['id'] in dist_cache[src['id']]:
-		return dist_cache[src['id']][dst['id']]
+	dist = dist_cache[src.index, dst.index]
+	metrics.count('dist_cache_lookups')
+	if dist == dist:
+		return dist
 	else:
+		metrics.count('dist_cache_misses')
 		return get_dist(src, dst)
 	
-def load_data(args):
-	# Read data
-	prefix = args.data_path.rstrip('/')
-	with open('%s/runways.csv' % prefix, 'rb') as csvfile:
-		runways = list(csv.DictReader(csvfile, delimiter=',', quotechar='"'))
-	with open('%s/supplemental_runways.csv' % prefix, 'rb') as csvfile:
-		runways.extend(list(csv.DictReader(csvfile, delimiter=',', quotechar='"')))
-	with open('%s/airports.csv' % prefix, 'rb') as csvfile:
-		airports = list(csv.DictReader(csvfile, delimiter=',', quotechar='"'))
-	with open('%s/supplemental_airports.csv' % prefix, 'rb') as csvfile:
-		airports.extend(list(csv.DictReader(csvfile, delimiter=',', quotechar='"')))
-	with open('%s/countries.csv' % prefix, 'rb') as csvfile:
-		countries = list(csv.DictReader(csvfile, delimiter=',', quotechar='"'))
+def read_csv_columns(filepaths, columns=None):
+	"""
+	Read csv files into a dict of column name -> list of strings, in file order.
+	If columns is given, only those columns are kept. Columns missing from one of
+	the files are filled in with ''.
+	"""
+	result = {}
+	total = 0
+	for filepath in filepaths:
+		with open(filepath, 'rb') as csvfile:
+			reader = csv.reader(csvfile, delimiter=',', quotechar='"')
+			header = next(reader)
+			rows = [row for row in reader if row]
+		for position, name in enumerate(header):
+			if not name or (columns is not None and name not in columns):
+				continue
+			if name not in result:
+				result[name] = [''] * total
+			result[name].extend([row[position] if position < len(row) else '' for row in rows])
+		total += len(rows)
+		for values in result.values():
+			values.extend([''] * (total - len(values)))
+	return result, total
+
+def airport_snapshot_key(prefix, args):
+	"""Hash of the source files and every setting that affects load_data"""
+	sha = hashlib.sha1()
+	for filename in AIRPORT_SNAPSHOT_SOURCES:
+		with open('%s/%s' % (prefix, filename), 'rb') as sourcefile:
+			sha.update(sourcefile.read())
+	for module in (blacklist, planes):
+		with open(os.path.splitext(module.__file__)[0] + '.py', 'rb') as sourcefile:
+			sha.update(sourcefile.read())
+	sha.update(filter_settings_hash(args))
+	sha.update(repr((sorted(args.start_from_airport_ids), sorted(args.start_from_airport_codes))))
+	return sha.digest()
+
+def read_airport_snapshot(filepath, key):
+	"""
+	The snapshot is a header (magic, version, key) followed by a pickle of the
+	filtered airport columns. Returns None if it's missing or stale.
+	"""
+	try:
+		with open(filepath, 'rb') as snapshotfile:
+			header = snapshotfile.read(AIRPORT_SNAPSHOT_HEADER.size)
+			if len(header) < AIRPORT_SNAPSHOT_HEADER.size:
+				return None
+			magic, version, snapshot_key = AIRPORT_SNAPSHOT_HEADER.unpack(header)
+			if magic != AIRPORT_SNAPSHOT_MAGIC or version != AIRPORT_SNAPSHOT_VERSION or snapshot_key != key:
+				return None
+			return cPickle.load(snapshotfile)
+	except (IOError, EOFError, cPickle.UnpicklingError):
+		return None
+
+def write_airport_snapshot(filepath, key, snapshot):
+	tmp_filepath = filepath + '.tmp'
+	with open(tmp_filepath, 'wb') as snapshotfile:
+		snapshotfile.write(AIRPORT_SNAPSHOT_HEADER.pack(AIRPORT_SNAPSHOT_MAGIC, AIRPORT_SNAPSHOT_VERSION, key))
+		cPickle.dump(snapshot, snapshotfile, cPickle.HIGHEST_PROTOCOL)
+	os.rename(tmp_filepath, filepath)
+
+def filter_airports(prefix, args):
+	"""
+	Parse the csv files and apply the runway filters and blacklists. Returns the
+	valid airports as columns (see load_data).
+	"""
+	# Read data, only keeping the runway columns we filter on
+	runways, runway_count = read_csv_columns(
+		['%s/runways.csv' % prefix, '%s/supplemental_runways.csv' % prefix], 
+		['airport_ident', 'length_ft', 'surface'])
+	airports, airport_count = read_csv_columns(
+		['%s/airports.csv' % prefix, '%s/supplemental_airports.csv' % prefix])
+	countries, _ = read_csv_columns(['%s/countries.csv' % prefix])
 
 	# Filter out runways that are too short or are not properly paved
 	plane = get_plane(1)
-	valid_runways = [r for r in runways if int(r.get('length_ft', 0) or 0) >= plane['min_runway_length_ft']]
+	lengths = np.array([int(length or 0) for length in runways['length_ft']], dtype=np.int32)
+	valid_runways = lengths >= plane['min_runway_length_ft']
 	
 	# Filter out badly paved runways
 	#   See ICAO surface definitions: https://en.wikipedia.org/wiki/Runway
-	valid_runways = [r for r in valid_runways if r.get('surface', '').upper()[:3] in ['ICE', 'ASP', 'CON', 'BIT', 'PEM']]
+	surfaces = np.array([surface.upper()[:3] for surface in runways['surface']])
+	valid_runways &= np.in1d(surfaces, ['ICE', 'ASP', 'CON', 'BIT', 'PEM'])
 
 	# Filter airports based on whether they contain a valid runway
-	airport_ids = [runway['airport_ident'] for runway in valid_runways]
-	airport_ids = set(airport_ids)
-	candidate_airports = [airport for airport in airports if airport['ident'] in airport_ids]
+	airport_ids = set(np.array(runways['airport_ident'])[valid_runways])
+	idents, types = airports['ident'], airports['type']
 	
 	# Filter out closed airports
-	candidate_airports = [airport for airport in candidate_airports if airport['type'] != 'closed']
+	candidates = [i for i in xrange(airport_count) if idents[i] in airport_ids and types[i] != 'closed']
 	
 	# Country code lookups
-	country_code_to_name = {}
-	country_name_to_code = {}
-	for country in countries:
-		country_code_to_name[country['code']] = country['name']
-		country_name_to_code[country['name']] = country['code']
+	country_code_to_name = dict(zip(countries['code'], countries['name']))
+	country_name_to_code = dict(zip(countries['name'], countries['code']))
 
 	# Country blacklists
-	blacklist_country_codes = []
+	blacklist_country_codes = set()
 	for country_name in blacklist.COUNTRY_BLACKLIST:
 		try:
-			iso_country = country_name_to_code[country_name]
-			blacklist_country_codes.append(iso_country)
-		except:
+			blacklist_country_codes.add(country_name_to_code[country_name])
+		except KeyError:
 			print "warning: country code not found for blacklisted country: %s" % country_name
 
 	# Geo-political overrides
 	geo_overrides = {}
 	for country_name, current_continent, new_continent in blacklist.GEO_OVERRIDES:
 		try:
-			iso_country = [country['code'] for country in countries if country['name'] == country_name][0]
-			geo_overrides[iso_country] = (current_continent, new_continent)
-		except:
+			geo_overrides[country_name_to_code[country_name]] = (current_continent, new_continent)
+		except KeyError:
 			print "warning: country code not found for blacklisted country: %s" % country_name
 	if args.disable_geo_overrides:
 		geo_overrides = {}
 
 	# Apply blacklists
-	valid_airports = []
-	for airport in candidate_airports:
-		if airport['iso_country'] in blacklist_country_codes:
+	continents = list(airports['continent'])
+	country_names = [''] * airport_count
+	selected = []
+	for i in candidates:
+		iso_country = airports['iso_country'][i]
+		if iso_country in blacklist_country_codes:
 			continue
-		airport['country_name'] = country_code_to_name[airport['iso_country']]
-		if airport['iso_country'] in geo_overrides.keys():
+		country_names[i] = country_code_to_name[iso_country]
+		if iso_country in geo_overrides:
 			# Allows possible re-assocation of continent
-			current_continent, new_continent = geo_overrides[airport['iso_country']]
-			if airport['continent'] == current_continent:
-				airport['continent'] = new_continent
-		if airport['ident'] in blacklist.AIRPORT_BLACKLIST:
+			current_continent, new_continent = geo_overrides[iso_country]
+			if continents[i] == current_continent:
+				continents[i] = new_continent
+		if idents[i] in blacklist.AIRPORT_BLACKLIST:
 			continue
-		if airport['iso_region'] in blacklist.ISO_REGION_BLACKLIST:
+		if airports['iso_region'][i] in blacklist.ISO_REGION_BLACKLIST:
 			continue
-		valid_airports.append(airport)
+		selected.append(i)
 		
 	# Add back hardcoded airports if needed
-	for airport in airports:
-		if int(airport['id']) in args.start_from_airport_ids and airport not in valid_airports: 
-			valid_airports.append(airport)
-		if airport['ident'] in args.start_from_airport_codes and airport not in valid_airports:
-			valid_airports.append(airport)
-		
-	# Generate lookup table
+	ids = np.array([int(airport_id) for airport_id in airports['id']], dtype=np.int32)
+	start_ids = set(args.start_from_airport_ids)
+	start_codes = set(args.start_from_airport_codes)
+	selected_set = set(selected)
+	for i in xrange(airport_count):
+		if i not in selected_set and (ids[i] in start_ids or idents[i] in start_codes):
+			selected.append(i)
+			selected_set.add(i)
+	
+	airports['continent'] = continents
+	airports['country_name'] = country_names
+	columns = dict((name, [values[i] for i in selected]) for name, values in airports.items())
+	return {
+		'columns': columns,
+		'ids': ids[selected],
+		'latitudes': np.array([float(airports['latitude_deg'][i]) for i in selected]),
+		'longitudes': np.array([float(airports['longitude_deg'][i]) for i in selected]),
+		'stats': (runway_count, int(valid_runways.sum()), len(airport_ids)),
+	}
+
+@metrics.timed('load_data')
+def load_data(args):
+	"""
+	The filtered airports are kept as columns: strings for the descriptive csv
+	fields plus typed arrays for the ids and coordinates. Filtering is cached in
+	a snapshot next to the csv files, so repeat runs with the same inputs skip
+	parsing the csv files entirely.
+	"""
+	return build_data(load_airport_snapshot(args), args)
+	
+def resolve_airport_codes(data, args):
+	"""Replace args.start_from_airport_ids with the ids of args.start_from_airport_codes, if any were given"""
+	if len(args.start_from_airport_codes) > 0:
+		args.start_from_airport_ids = []
+		for code in args.start_from_airport_codes:
+			for airport in data['all_airports']:
+				if airport.ident == code:
+					args.start_from_airport_ids.append(airport.id)
+
+def load_airport_snapshot(args):
+	prefix = args.data_path.rstrip('/')
+	st = time.time()
+	filepath = '%s/airport_snapshot.dat' % prefix
+	key = airport_snapshot_key(prefix, args)
+	snapshot = read_airport_snapshot(filepath, key)
+	if snapshot is None:
+		snapshot = filter_airports(prefix, args)
+		write_airport_snapshot(filepath, key, snapshot)
+		print "Parsed airport data in %.2fs" % (time.time() - st)
+	else:
+		print "Loaded airport snapshot in %.2fs" % (time.time() - st)
+	return snapshot
+	
+def build_data(snapshot, args):
+	"""Airport records and lookup tables for the airports in a snapshot"""
+	# Build the airport records. Each airport's index is its row in the columns,
+	# which is also its row / column in the distance matrix.
+	columns = snapshot['columns']
+	valid_airports = []
 	valid_airports_by_id = {}
-	for airport in valid_airports:
-		valid_airports_by_id[str(airport['id'])] = airport
+	for i, (airport_id, ident, airport_type, continent, latitude, longitude) in enumerate(zip(
+			snapshot['ids'].tolist(), columns['ident'], columns['type'], columns['continent'],
+			snapshot['latitudes'].tolist(), snapshot['longitudes'].tolist())):
+		airport = Airport(i, airport_id, ident, airport_type, continent, latitude, longitude, columns)
+		valid_airports.append(airport)
+		valid_airports_by_id[airport_id] = airport
 
 	# Hash airports by lat/long
-	table = generate_geo_hash_table(args.geo_hash_resolution_deg, valid_airports)
+	if args.geo_hash_budget:
+		table = generate_adaptive_hash_table(args.geo_hash_budget, valid_airports)
+	else:
+		table = generate_geo_hash_table(args.geo_hash_resolution_deg, valid_airports)
 	
 	data = {
 		'hash_table': table,
 		'all_airports': valid_airports,
 		'all_airports_by_id': valid_airports_by_id,
+		'ids': snapshot['ids'],
+		'latitudes': snapshot['latitudes'],
+		'longitudes': snapshot['longitudes'],
+		'continents': np.array(columns['continent']),
+		'types': np.array(columns['type']),
 	}
+	data['continent_masks'] = dict((cont, data['continents'] == cont) for cont in set(data['continents']))
+	
+	# Index airports by location for radius / nearest airport queries
+	data['spatial_index'] = spatial.SpatialIndex(data['latitudes'], data['longitudes'], EARTH_RADIUS_MI)
 
+	runway_count, valid_runway_count, airport_count = snapshot['stats']
 	print "Runway stats:"
-	print "\t%i total" % len(runways)
-	print "\t%i w/ length > %s ft and paved" % (len(valid_runways), plane['min_runway_length_ft'])
-	print "\t%i unique airports" % len(airport_ids)
+	print "\t%i total" % runway_count
+	print "\t%i w/ length > %s ft and paved" % (valid_runway_count, get_plane(1)['min_runway_length_ft'])
+	print "\t%i unique airports" % airport_count
 	print "\t%i airports after applying blacklist" % len(valid_airports)
 				
 	return data
@@ -322,172 +806,928 @@ def url_for_route(route, api_key):
 	url = base + urllib.urlencode(params)
 	return url
 	
-def generate_ordered_sequences(waypoint_lists):
+def sample_ordered_sequences(choices, max_count, rng=random):
 	"""
-	Given an ordered list of lists of possible choices, generate all possible
-	ordered sequences.
+	Given an ordered list of arrays of possible choices, lazily generate up to
+	max_count distinct ordered sequences, as 2D arrays of up to
+	SEQUENCE_BATCH_SIZE sequences each. If there are more possible sequences
+	than that, a random sample of them is generated by decoding random indices
+	into the product, so memory use doesn't depend on its size.
 	"""
-	sequences = []
-	if len(waypoint_lists) == 0:
-		return []
-	if len(waypoint_lists) > 1:
-		for node in waypoint_lists[0]:
-			for child in generate_ordered_sequences(waypoint_lists[1:]):
-				if type(child) == list:
-					sequences.append([node] + child)
-				else:
-					sequences.append([node] + [child])
+	total = 1
+	for options in choices:
+		total *= len(options)
+	if total <= max_count:
+		flat_indices = np.arange(total)
 	else:
-		sequences = waypoint_lists[0]
-	return sequences
+		flat_indices = np.array(rng.sample(xrange(total), max_count), dtype=np.int64)
+	for start in xrange(0, len(flat_indices), SEQUENCE_BATCH_SIZE):
+		flat = flat_indices[start:start + SEQUENCE_BATCH_SIZE]
+		batch = np.empty((len(flat), len(choices)), dtype=np.int32)
+		for i in reversed(range(len(choices))):
+			flat, positions = np.divmod(flat, len(choices[i]))
+			batch[:, i] = choices[i][positions]
+		yield batch
+	
+def get_reorderings(waypoints, start):
+	"""
+	Every order of waypoints reachable by reversing a run of waypoints (2-opt) or
+	moving one waypoint to another position (or-opt), leaving those before 
+	position start in place.
+	"""
+	for i in range(start, len(waypoints)):
+		for j in range(i + 1, len(waypoints)):
+			yield waypoints[:i] + waypoints[i:j + 1][::-1] + waypoints[j + 1:]
+	for i in range(start, len(waypoints)):
+		rest = waypoints[:i] + waypoints[i + 1:]
+		for j in range(start, len(waypoints)):
+			# Moving to an adjacent position is the same as a 2-opt swap
+			if abs(i - j) > 1:
+				yield rest[:j] + [waypoints[i]] + rest[j:]
 	
 class Search(object):
 	
 	def __init__(self, data, args):
 		self.data = data
 		self.args = args
+		table = self.data['hash_table']
+		self.buckets = [table[key] for key in sorted(table)]
+		# Set by run_search from args.time_budget
+		self.deadline = None
+		self.seed(args.seed)
 		self.setup_search()
+		
+	def seed(self, seed):
+		"""
+		Give each randomized part of the search its own RNG stream derived from
+		seed, so that a run can be reproduced with --seed, and a change in how
+		much one part draws doesn't change what the others draw.
+		"""
+		self.shuffle_random = random.Random(derive_seed(seed, 'shuffle'))
+		self.optimize_random = random.Random(derive_seed(seed, 'optimize'))
+		self.route_rng = np.random.RandomState(derive_seed(seed, 'routes'))
+		
+	def get_checkpoint_state(self, best_routes, progress):
+		"""
+		What's needed to pick the search up where it left off: the best routes and
+		the search loop's progress, plus the RNG streams and the current geo hash
+		representatives. The search loops take this between batches, so that a 
+		checkpoint written after a ctrl-c never includes half of a batch.
+		"""
+		return {
+			'seed': self.args.seed,
+			'progress': progress,
+			'counters': dict((name, value) for name, value in metrics.counters.items() if name in CHECKPOINT_COUNTERS),
+			'best_routes': [route.indices for route in best_routes.get_routes()],
+			'representatives': list(self.representatives),
+			'shuffle_random': self.shuffle_random.getstate(),
+			'optimize_random': self.optimize_random.getstate(),
+			'route_rng': self.route_rng.get_state(),
+		}
+		
+	@metrics.timed('checkpoint')
+	def save_checkpoint(self, filepath, state):
+		"""
+		Write a state from get_checkpoint_state to filepath. Airports are saved as
+		ids, so the checkpoint doesn't depend on the order of the airports.
+		"""
+		all_airports = self.data['all_airports']
+		state = dict(state)
+		state['best_routes'] = [[all_airports[index].id for index in indices] for indices in state['best_routes']]
+		state['representatives'] = [airport.id for airport in state['representatives']]
+		if 'population' in state['progress']:
+			state['progress'] = dict(state['progress'])
+			state['progress']['population'] = [[all_airports[index].id for index in route] for route in state['progress']['population'].tolist()]
+		write_checkpoint(filepath, checkpoint_key(self.data, self.args), state)
+		metrics.emit('checkpoint', filepath=filepath, searches=state['progress']['search_count'])
+		
+	def load_checkpoint(self, filepath, best_routes, stop):
+		"""
+		Restore a checkpoint written by save_checkpoint into this search, 
+		best_routes and stop (see StopCondition). Returns the saved progress, or
+		None if there is no checkpoint at filepath yet.
+		"""
+		state = read_checkpoint(filepath, checkpoint_key(self.data, self.args))
+		if state is None:
+			print "No checkpoint found at %s, starting a new search" % filepath
+			return None
+		self.args.seed = state['seed']
+		self.shuffle_random.setstate(state['shuffle_random'])
+		self.optimize_random.setstate(state['optimize_random'])
+		self.route_rng.set_state(state['route_rng'])
+		self.representatives = [self.get_airport_by_id(airport_id) for airport_id in state['representatives']]
+		self.update_representatives()
+		for airport_ids in state['best_routes']:
+			best_routes.add(Route([self.get_airport_by_id(airport_id).index for airport_id in airport_ids], self.data['all_airports']))
+		for name, value in state['counters'].items():
+			metrics.count(name, value)
+		stop.reference_duration = state['progress']['reference_duration']
+		stop.reference_count = state['progress']['reference_count']
+		print "Resuming search from %s (seed %i, %i routes searched)" % (filepath, state['seed'], state['progress']['search_count'])
+		return state['progress']
 
 	def get_airport_by_id(self, id):
-		return self.data['all_airports_by_id'][str(id)]
-				
-	def get_airports_by_continent(self, continent):
-		return self.data['airports_by_continent'][continent]
-
-	def pick_airport(self, waypoints, candidates, max_attempts=None):
-		airport = None
-		attempts = 0
-		if max_attempts is None:
-			max_attempts = len(candidates)
-		while attempts < max_attempts:
-			airport = random.choice(candidates)
-			if len(waypoints) == 0:
-				return airport
-			prev_waypoint = waypoints[-1]
-			seg_num = len(waypoints)
-			plane = get_plane(seg_num)
-			if Route.valid_segment(plane, prev_waypoint, airport, self.data, self.args):
-				return airport
-			else:
-				attempts += 1
-		return None
-		
+		return self.data['all_airports_by_id'][int(id)]
+
 	def sort_routes(self, routes):
-		return sorted(routes, key=lambda x: x.get_duration(self.data, self.args))
+		"""
+		Routes from fastest to slowest, without duplicates. Different routes often
+		optimize to the same local optimum.
+		"""
+		distinct = BestRoutes(len(routes), self.data, self.args)
+		for route in routes:
+			distinct.add(route)
+		return distinct.get_routes()
 
-	def update_best_routes(self, best_routes, route):
-		best_routes.append(route)
-		best_routes = self.sort_routes(best_routes)[:args.num_best_routes]
-		return best_routes
-		
+	@metrics.timed('optimize_route')
 	def optimize_route(self, route, radius, max_searches):
-		waypoint_lists = []
-		waypoints = route.waypoints
-		best_route = route
-		for i, waypoint in enumerate(waypoints):
-			if i < len(args.start_from_airport_ids):
-				waypoint_lists.append([waypoint])
+		choices = []
+		for i, waypoint in enumerate(route.waypoints):
+			if i < len(self.args.start_from_airport_ids):
+				choices.append(np.array([waypoint.index]))
 			else:
-				candidates = [candidate for candidate in self.data['all_airports'] if get_dist_from_cache(data['dist_cache'], waypoint, candidate) < radius]
-				candidates = [candidate for candidate in candidates if candidate['continent'] == waypoint['continent']]
-				candidates = random.sample(candidates, min(12, len(candidates)))
-				waypoint_lists.append(candidates)
-		all_sequences = generate_ordered_sequences(waypoint_lists)
-		sequences = random.sample(all_sequences, min(len(all_sequences), max_searches))
-		for i, sequence in enumerate(sequences):		
-			best_route = self.update_best_routes([best_route], Route(sequence))[0]
-		return best_route, len(sequences)
+				candidates = self.get_nearby_airports(waypoint, radius)
+				choices.append(np.array(self.optimize_random.sample(candidates, min(12, len(candidates)))))
+		count = 0
+		best_indices = route.indices
+		best_duration = route.get_duration(self.data, self.args)
+		for batch in sample_ordered_sequences(choices, max_searches, self.optimize_random):
+			count += len(batch)
+			durations = get_route_durations(batch, self.data)
+			best = durations.argmin()
+			if durations[best] < best_duration:
+				best_indices = batch[best]
+				best_duration = durations[best]
+		if best_indices is route.indices:
+			return route, count
+		return Route(best_indices, self.data['all_airports']), count
+		
+	@metrics.timed('improve_route')
+	def improve_route(self, route, radius):
+		"""
+		Local search improvement of a route. Each waypoint is swapped for the best
+		airport in the same continent within radius miles, given its neighbors, and
+		the continent order is changed by reversing a run of waypoints (2-opt) or
+		moving a single waypoint elsewhere (or-opt). This repeats until no move
+		makes the route faster. Hardcoded start airports and continents are kept.
+		"""
+		indices = route.indices.tolist()
+		fixed_airports = len(self.args.start_from_airport_ids)
+		fixed_order = max(fixed_airports, len(self.args.start_from_continent_codes))
+		count = 0
+		improved = True
+		while improved:
+			improved = False
+			for i in range(fixed_airports, len(indices)):
+				index, evaluated = self.get_best_alternate(indices, i, radius)
+				count += evaluated
+				if index != indices[i]:
+					indices[i] = index
+					improved = True
+			candidates = np.array(list(get_reorderings(indices, fixed_order)), dtype=np.int32)
+			count += len(candidates)
+			if len(candidates) == 0:
+				continue
+			durations = get_route_durations(candidates, self.data)
+			durations[~get_valid_routes(candidates, self.data, self.args)] = np.inf
+			best = durations.argmin()
+			if durations[best] < get_route_durations(np.array([indices]), self.data)[0]:
+				indices = candidates[best].tolist()
+				improved = True
+		return Route(indices, self.data['all_airports']), count
+		
+	def get_best_alternate(self, indices, i, radius):
+		"""
+		The fastest airport to use at position i of a route, among same continent
+		airports within radius miles of the current one, given the airports before
+		and after it. Returns the airport's index and the number of candidates
+		scored.
+		"""
+		candidates = self.get_nearby_airports(self.data['all_airports'][indices[i]], radius)
+		cost = np.zeros(len(candidates))
+		if i > 0:
+			cost += self.get_segment_block(i, np.array([indices[i - 1]]), candidates)[0]
+		if i < len(indices) - 1:
+			cost += self.get_segment_block(i + 1, candidates, np.array([indices[i + 1]]))[:, 0]
+		best = cost.argmin()
+		current = cost[candidates == indices[i]]
+		if len(current) > 0 and cost[best] >= current[0]:
+			return indices[i], len(candidates)
+		if not np.isfinite(cost[best]):
+			return indices[i], len(candidates)
+		return candidates[best], len(candidates)
+		
+	def get_nearby_airports(self, waypoint, radius):
+		"""Indices of airports in the same continent within radius miles of waypoint"""
+		indices, dists = self.data['spatial_index'].query_radius(
+			waypoint.latitude, waypoint.longitude, radius,
+			mask=self.data['continent_masks'][waypoint.continent])
+		return indices
 		
+	@metrics.timed('setup_search')
 	def setup_search(self):
 		print "Setting up search..."
-		airports = [random.choice(airports) for airports in self.data['hash_table'].values()]
-		airports += [self.get_airport_by_id(airport_id) for airport_id in self.args.start_from_airport_ids]
+		self.reshuffle()
+		
+	@metrics.timed('reshuffle')
+	def reshuffle(self):
+		"""
+		Pick a new representative for every hash bucket. This only touches the 
+		already loaded distance matrix, so it's done between search batches 
+		rather than by reloading the data.
+		"""
+		self.representatives = [self.shuffle_random.choice(airports) for airports in self.buckets]
+		self.update_representatives()
+		
+	def update_representatives(self):
+		airports = self.representatives + [self.get_airport_by_id(airport_id) for airport_id in self.args.start_from_airport_ids]
 		self.data['airports'] = airports
-		self.data['dist_cache'] = load_dist_cache(self.args.data_path.rstrip('/'), self.data['airports'])
 		airports_by_continent = {}
 		for airport in airports:
-			cont = airport['continent']
+			cont = airport.continent
 			if cont not in airports_by_continent:
 				airports_by_continent[cont] = [airport]
 			else:
 				airports_by_continent[cont].append(airport)	
 		self.data['airports_by_continent'] = airports_by_continent
+		self.setup_reachability()
 
-	def run(self):
+	def setup_reachability(self):
+		"""
+		For each plane range, precompute which airports can be reached from each
+		source airport, so that generate_routes never has to reject a candidate.
+		Rows are source airports (see data['source_rows']) and continents are in
+		data['continent_codes'] order. The candidate airports are grouped by
+		continent in data['targets'], continent c starting at target_offsets[c].
+			reachable_counts[max_range] - number of airports reachable in each 
+				continent, one column per continent
+			reachable[max_range] - positions in targets, with the reachable 
+				airports first within each continent's columns
+		"""
+		overhead = 1.0 + self.args.routing_overhead_pct / 100.0
+		sources = np.array(sorted(set(airport.index for airport in self.data['airports'])))
+		source_rows = np.zeros(len(self.data['all_airports']), dtype=np.int32)
+		source_rows[sources] = np.arange(len(sources))
+		lengths = self.data['dist_cache'][np.ix_(sources, sources)] * overhead
+		continents = sorted(self.data['airports_by_continent'])
+		targets = [np.array([airport.index for airport in self.data['airports_by_continent'][cont]]) for cont in continents]
+		sizes = np.array([len(indices) for indices in targets])
+		offsets = np.concatenate(([0], sizes.cumsum()[:-1]))
+		ranges = set(get_plane(seg_num)['max_range_mi'] for seg_num in planes.plane_to_segment)
+		reachable = dict((max_range, []) for max_range in ranges)
+		reachable_counts = dict((max_range, np.zeros((len(sources), len(continents)), dtype=np.int32)) for max_range in ranges)
+		for c, indices in enumerate(targets):
+			cont_lengths = lengths[:, source_rows[indices]]
+			for max_range in ranges:
+				unreachable = ~(cont_lengths < max_range)
+				reachable_counts[max_range][:, c] = len(indices) - unreachable.sum(axis=1)
+				reachable[max_range].append(unreachable.argsort(axis=1).astype(np.int32) + offsets[c])
+		self.data['source_rows'] = source_rows
+		self.data['continent_codes'] = continents
+		self.data['targets'] = np.concatenate(targets).astype(np.int32)
+		self.data['target_offsets'] = offsets
+		self.data['target_sizes'] = sizes
+		self.data['reachable'] = dict((max_range, np.hstack(reachable[max_range])) for max_range in ranges)
+		self.data['reachable_counts'] = reachable_counts
+
+	def generate_routes(self, count):
+		"""
+		Build count random routes out of the geo hash representatives at once. At
+		each step a route picks a random continent it hasn't visited yet that has
+		an airport in range, then a random airport in range in that continent.
+		Hardcoded start airports and continents are used as is. Returns a (count x
+		7) array of airport indices and a mask of the routes that could be 
+		completed.
+		"""
+		start_ids = self.args.start_from_airport_ids
+		start_continents = self.args.start_from_continent_codes
+		continents = self.data['continent_codes']
+		offsets = self.data['target_offsets']
+		routes = np.zeros((count, 7), dtype=np.int32)
+		visited = np.zeros((count, len(continents)), dtype=bool)
+		complete = np.ones(count, dtype=bool)
+		everyone = np.arange(count)
+		for step in range(7):
+			if step < len(start_ids):
+				airport = self.get_airport_by_id(start_ids[step])
+				routes[:, step] = airport.index
+				visited[:, continents.index(airport.continent)] = True
+				continue
+			if step > 0:
+				max_range = get_plane(step)['max_range_mi']
+				rows = self.data['source_rows'][routes[:, step - 1]]
+				counts = self.data['reachable_counts'][max_range][rows]
+			if step < len(start_continents):
+				choice = np.empty(count, dtype=np.int32)
+				choice.fill(continents.index(start_continents[step]))
+				if step > 0:
+					complete &= counts[everyone, choice] > 0
+			else:
+				allowed = ~visited
+				if step > 0:
+					allowed &= counts > 0
+				num_allowed = allowed.sum(axis=1)
+				complete &= num_allowed > 0
+				picks = (self.route_rng.random_sample(count) * num_allowed).astype(np.int32)
+				choice = (allowed.cumsum(axis=1) > picks[:, np.newaxis]).argmax(axis=1)
+			picks = self.route_rng.random_sample(count)
+			if step == 0:
+				positions = offsets[choice] + (picks * self.data['target_sizes'][choice]).astype(np.int32)
+			else:
+				columns = offsets[choice] + (picks * counts[everyone, choice]).astype(np.int32)
+				positions = self.data['reachable'][max_range][rows, columns]
+			routes[:, step] = self.data['targets'][positions]
+			visited[everyone, choice] = True
+		return routes, complete
+
+	def search_parallel(self):
+		"""
+		Run search_random in args.workers processes, each with its own seed and
+		share of max_searches, and merge their best routes. Workers are forked, so
+		they read the distance and duration matrices from the parent's memory
+		instead of being sent a copy.
+		"""
+		global search_worker_state
+		search_worker_state = self
+		workers = self.args.workers
+		shares = [self.args.max_searches // workers + (1 if i < self.args.max_searches % workers else 0) for i in range(workers)]
+		# Each worker checkpoints to its own file
+		checkpoint_files = [self.args.checkpoint_file and '%s.worker%i' % (self.args.checkpoint_file, i) for i in range(workers)]
+		jobs = [(derive_seed(self.args.seed, 'worker%i' % i), share, checkpoint_files[i]) for i, share in enumerate(shares)]
+		print "Running search in %i worker processes..." % workers
+		pool = multiprocessing.Pool(workers)
+		pending = pool.map_async(random_search_worker, jobs)
+		while True:
+			try:
+				worker_results = pending.get(SEARCH_WORKER_POLL)
+				break
+			except multiprocessing.TimeoutError:
+				continue
+			except KeyboardInterrupt:
+				# Workers got the ctrl-c as well and are returning what they found
+				print "Interrupted, collecting results from workers..."
+		pool.close()
+		pool.join()
+		
 		search_count = 0
 		valid_route_count = 0
+		best_routes = BestRoutes(self.args.num_best_routes, self.data, self.args)
+		all_airports = self.data['all_airports']
+		for paths, count, valid_count, counters in worker_results:
+			search_count += count
+			valid_route_count += valid_count
+			for path in paths:
+				best_routes.add(Route(path, all_airports))
+			for name, value in counters.items():
+				metrics.count(name, value)
+		metrics.emit('best', duration_hrs=best_routes.get_best_duration(), searches=search_count)
+		return best_routes.get_routes(), search_count, valid_route_count
+		
+	def search_random(self, max_searches=None, checkpoint_file=None):
+		"""
+		Build random routes out of the geo hash representatives until max_searches
+		is reached (or ctrl-c), reshuffling the representatives periodically. If
+		checkpoint_file is given the search state is saved to it every 
+		args.checkpoint_interval seconds and when the search ends, and with 
+		args.resume the search continues from it.
+		"""
+		if max_searches is None:
+			max_searches = self.args.max_searches
+		search_count = 0
+		valid_route_count = 0
+		best_routes = BestRoutes(self.args.num_best_routes, self.data, self.args)
+		stop = StopCondition(self.args, self.deadline)
+		if checkpoint_file and self.args.resume:
+			progress = self.load_checkpoint(checkpoint_file, best_routes, stop)
+			if progress is not None:
+				search_count = progress['search_count']
+				valid_route_count = progress['valid_route_count']
 		last_log_time = time.time()
-		last_search_count = 0
-		best_routes = []
-		start_time = time.time()
-		reshuffle_count = int(args.max_searches / args.geo_hash_shuffles)
+		last_checkpoint_time = time.time()
+		last_search_count = search_count
+		reshuffle_count = max(1, int(max_searches / self.args.geo_hash_shuffles))
+		
+		# Routes with every airport hardcoded only need to be built once
+		batch_size = 1 if len(self.args.start_from_airport_ids) >= 7 else SEARCH_BATCH_SIZE
+		
+		def snapshot():
+			return self.get_checkpoint_state(best_routes, self.get_progress(search_count, valid_route_count, stop))
 		
 		print "Running search..."
 		
+		interrupted = False
+		state = snapshot() if checkpoint_file else None
 		try:
-			while search_count < args.max_searches:
+			while search_count < max_searches:
+				if checkpoint_file:
+					state = snapshot()
 			
-				# Do search
-				waypoints = []
-				visited_continents = []
-				while len(visited_continents) < 7:
-					remaining = set(self.data['airports_by_continent'].keys()) - set(visited_continents)
-					airport = None
-					if len(self.args.start_from_airport_ids) > len(waypoints):
-						airport_id = self.args.start_from_airport_ids[len(waypoints)]
-						airport = self.get_airport_by_id(airport_id)
-					elif len(self.args.start_from_continent_codes) > len(visited_continents):
-						continent = self.args.start_from_continent_codes[len(visited_continents)]
-						airport = self.pick_airport(waypoints, self.get_airports_by_continent(continent), max_attempts=10)
-					else:
-						continent = random.choice(list(remaining))
-						airport = self.pick_airport(waypoints, self.get_airports_by_continent(continent), max_attempts=10)
-					if airport is None:
-						break
-					waypoints.append(airport)
-					visited_continents.append(airport['continent'])
-				search_count += 1
+				# Do search, stopping at the next reshuffle
+				count = min(batch_size, max_searches - search_count, reshuffle_count - search_count % reshuffle_count)
+				routes, complete = self.generate_routes(count)
+				routes = routes[complete]
+				best_duration = best_routes.get_best_duration()
+				best_routes.add_batch(routes, get_route_durations(routes, self.data))
+				search_count += count
+				valid_route_count += len(routes)
+				metrics.count('searches', count)
+				metrics.count('valid_routes', len(routes))
+				metrics.count('dead_ends', count - len(routes))
+				if best_routes.get_best_duration() != best_duration:
+					metrics.emit('best', duration_hrs=best_routes.get_best_duration(), searches=search_count)
 			
 				# Periodic logging
 				if time.time() - last_log_time > 5.0:
-					if len(best_routes) > 0:
-						hrs = best_routes[0].get_duration(data, args)
-					else:
-						hrs = 0.0
-					search_rate = (search_count - last_search_count) / 5.0
+					hrs = best_routes.get_best_duration()
+					search_rate = (search_count - last_search_count) / (time.time() - last_log_time)
 					print "Searched %i routes (%i/s) and found %s valid routes (best is %.2f hrs)" % (search_count, search_rate, valid_route_count, hrs)
+					metrics.emit('progress', searches=search_count, valid_routes=valid_route_count, searches_per_s=search_rate, best_duration_hrs=hrs)
 					last_log_time = time.time()
 					last_search_count = search_count
 				
 				# Perodic shuffling
 				if search_count % reshuffle_count == 0:
-					self.setup_search()
+					self.reshuffle()
 					print "Completed a batch of %s searches, reshuffled airports in each geo hash." % reshuffle_count
-			
-				# There were no valid segments from last waypoint
-				if len(visited_continents) < 7:
-					continue
-				valid_route_count += 1
-				route = Route(waypoints)
-				best_routes = self.update_best_routes(best_routes, route)
 				
 				# Early exit for fully hardcoded route
-				if len(self.args.start_from_airport_ids) == 7:
+				if batch_size == 1:
+					break
+				
+				if stop.should_stop(search_count, best_routes.get_best_duration()):
+					print "Stopping search after %i routes: %s" % (search_count, stop.reason)
+					metrics.emit('stop', reason=stop.reason, searches=search_count)
 					break
 					
+				# Periodic checkpoints
+				if checkpoint_file and time.time() - last_checkpoint_time > self.args.checkpoint_interval:
+					self.save_checkpoint(checkpoint_file, snapshot())
+					last_checkpoint_time = time.time()
+					
 		except KeyboardInterrupt:
-			pass
+			interrupted = True
 		
-		elapsed_time = time.time() - start_time
+		if checkpoint_file:
+			# After a ctrl-c, the state from the start of the interrupted batch
+			self.save_checkpoint(checkpoint_file, state if interrupted else snapshot())
+		return best_routes.get_routes(), search_count, valid_route_count
+		
+	def get_progress(self, search_count, valid_route_count, stop, **fields):
+		"""The progress of a search loop, as saved in its checkpoints"""
+		progress = {
+			'search_count': search_count,
+			'valid_route_count': valid_route_count,
+			'reference_duration': stop.reference_duration,
+			'reference_count': stop.reference_count,
+		}
+		progress.update(fields)
+		return progress
+		
+	def search_shuffles(self, solve):
+		"""
+		Run a deterministic solver once per reshuffle of the geo hash
+		representatives, and keep the best routes across all of them.
+		"""
+		search_count = 0
+		valid_route_count = 0
+		completed_shuffles = 0
+		best_routes = BestRoutes(self.args.num_best_routes, self.data, self.args)
+		stop = StopCondition(self.args, self.deadline)
+		checkpoint_file = self.args.checkpoint_file
+		if checkpoint_file and self.args.resume:
+			progress = self.load_checkpoint(checkpoint_file, best_routes, stop)
+			if progress is not None:
+				search_count = progress['search_count']
+				valid_route_count = progress['valid_route_count']
+				completed_shuffles = progress['shuffles']
+		last_checkpoint_time = time.time()
+		
+		def snapshot():
+			return self.get_checkpoint_state(best_routes, self.get_progress(search_count, valid_route_count, stop, shuffles=completed_shuffles))
 		
-		# Remove dups
+		print "Running %s search..." % self.args.solver
+		
+		interrupted = False
+		state = snapshot() if checkpoint_file else None
+		try:
+			for shuffle in range(completed_shuffles, self.args.geo_hash_shuffles):
+				if checkpoint_file:
+					state = snapshot()
+				if shuffle > 0:
+					self.setup_search()
+				with metrics.timer(self.args.solver):
+					routes, count = solve()
+				search_count += count
+				valid_route_count += len(routes)
+				metrics.count('searches', count)
+				metrics.count('valid_routes', len(routes))
+				for route in routes:
+					best_routes.add(route)
+				completed_shuffles = shuffle + 1
+				hrs = best_routes.get_best_duration()
+				print "Solved shuffle %i of %i, searched %i segments (best is %.2f hrs)" % (shuffle + 1, self.args.geo_hash_shuffles, search_count, hrs)
+				metrics.emit('progress', shuffle=shuffle + 1, searches=search_count, valid_routes=valid_route_count, best_duration_hrs=hrs)
+				if stop.should_stop(search_count, hrs):
+					print "Stopping search after %i shuffles: %s" % (shuffle + 1, stop.reason)
+					metrics.emit('stop', reason=stop.reason, searches=search_count)
+					break
+				if checkpoint_file and time.time() - last_checkpoint_time > self.args.checkpoint_interval:
+					self.save_checkpoint(checkpoint_file, snapshot())
+					last_checkpoint_time = time.time()
+		except KeyboardInterrupt:
+			interrupted = True
+		
+		if checkpoint_file:
+			# After a ctrl-c, the state from the start of the interrupted shuffle
+			self.save_checkpoint(checkpoint_file, state if interrupted else snapshot())
+		return best_routes.get_routes(), search_count, valid_route_count
+		
+	def search_genetic(self):
+		"""
+		Evolve a population of args.population_size routes instead of sampling 
+		every route independently. The population starts as the best of a batch
+		of random routes, and each generation breeds as many children as there are
+		routes in the population (see breed). The children that are in range are
+		scored like any other batch, and the fastest distinct routes among the 
+		parents and children survive. max_searches counts scored routes.
+		"""
+		search_count = 0
+		valid_route_count = 0
+		generation = 0
+		best_routes = BestRoutes(self.args.num_best_routes, self.data, self.args)
+		stop = StopCondition(self.args, self.deadline)
+		checkpoint_file = self.args.checkpoint_file
+		self.setup_mutations()
+		population = None
+		if checkpoint_file and self.args.resume:
+			progress = self.load_checkpoint(checkpoint_file, best_routes, stop)
+			if progress is not None:
+				search_count = progress['search_count']
+				valid_route_count = progress['valid_route_count']
+				generation = progress['generation']
+				population = np.array([[self.get_airport_by_id(airport_id).index for airport_id in airport_ids] for airport_ids in progress['population']], dtype=np.int32)
+		if population is None:
+			routes, complete = self.generate_routes(SEARCH_BATCH_SIZE)
+			valid = int(complete.sum())
+			search_count += len(routes)
+			valid_route_count += valid
+			metrics.count('searches', len(routes))
+			metrics.count('valid_routes', valid)
+			metrics.count('dead_ends', len(routes) - valid)
+			population = np.unique(routes[complete], axis=0)
+		durations = get_route_durations(population, self.data)
+		best_routes.add_batch(population, durations)
+		keep = np.argsort(durations, kind='mergesort')[:self.args.population_size]
+		population, durations = population[keep], durations[keep]
+		last_log_time = time.time()
+		last_checkpoint_time = time.time()
+		last_search_count = search_count
+		
+		def snapshot():
+			return self.get_checkpoint_state(best_routes, self.get_progress(search_count, valid_route_count, stop, generation=generation, population=population))
+		
+		print "Running genetic search..."
+		
+		interrupted = False
+		state = snapshot() if checkpoint_file else None
+		try:
+			# Routes with every airport hardcoded have nothing to evolve
+			while search_count < self.args.max_searches and len(population) > 0 and len(self.args.start_from_airport_ids) < 7:
+				if checkpoint_file:
+					state = snapshot()
+				children = self.breed(population, durations, min(len(population), self.args.max_searches - search_count))
+				count = len(children)
+				children = children[get_valid_routes(children, self.data, self.args)]
+				search_count += count
+				valid_route_count += len(children)
+				metrics.count('searches', count)
+				metrics.count('valid_routes', len(children))
+				metrics.count('dead_ends', count - len(children))
+				child_durations = get_route_durations(children, self.data)
+				best_duration = best_routes.get_best_duration()
+				best_routes.add_batch(children, child_durations)
+				if best_routes.get_best_duration() != best_duration:
+					metrics.emit('best', duration_hrs=best_routes.get_best_duration(), searches=search_count)
+				
+				# Survivors are the fastest distinct routes of both generations
+				population = np.vstack((population, children))
+				durations = np.concatenate((durations, child_durations))
+				population, first = np.unique(population, axis=0, return_index=True)
+				durations = durations[first]
+				keep = np.argsort(durations, kind='mergesort')[:self.args.population_size]
+				population, durations = population[keep], durations[keep]
+				generation += 1
+				
+				# Periodic logging
+				if time.time() - last_log_time > 5.0:
+					hrs = best_routes.get_best_duration()
+					search_rate = (search_count - last_search_count) / (time.time() - last_log_time)
+					print "Bred %i generations, scored %i routes (%i/s) and found %s valid routes (best is %.2f hrs)" % (generation, search_count, search_rate, valid_route_count, hrs)
+					metrics.emit('progress', generation=generation, searches=search_count, valid_routes=valid_route_count, searches_per_s=search_rate, best_duration_hrs=hrs)
+					last_log_time = time.time()
+					last_search_count = search_count
+				
+				if stop.should_stop(search_count, best_routes.get_best_duration()):
+					print "Stopping search after %i generations: %s" % (generation, stop.reason)
+					metrics.emit('stop', reason=stop.reason, searches=search_count)
+					break
+				
+				if checkpoint_file and time.time() - last_checkpoint_time > self.args.checkpoint_interval:
+					self.save_checkpoint(checkpoint_file, snapshot())
+					last_checkpoint_time = time.time()
+		except KeyboardInterrupt:
+			interrupted = True
+		
+		if checkpoint_file:
+			# After a ctrl-c, the state from the start of the interrupted generation
+			self.save_checkpoint(checkpoint_file, state if interrupted else snapshot())
+		return best_routes.get_routes(), search_count, valid_route_count
+		
+	def setup_mutations(self):
+		"""
+		Lookup tables for breed, over all airports rather than just the geo hash
+		representatives. Airports are grouped by continent and by geo hash bucket,
+		group g being members[offsets[g]:offsets[g] + sizes[g]].
+		"""
+		continents = sorted(set(self.data['continents']))
+		self.airport_continents = np.searchsorted(continents, self.data['continents']).astype(np.int32)
+		self.continent_members = np.argsort(self.airport_continents, kind='mergesort').astype(np.int32)
+		self.continent_sizes = np.bincount(self.airport_continents, minlength=len(continents))
+		self.continent_offsets = np.concatenate(([0], self.continent_sizes.cumsum()[:-1]))
+		self.bucket_members = np.array([airport.index for airports in self.buckets for airport in airports], dtype=np.int32)
+		self.bucket_sizes = np.array([len(airports) for airports in self.buckets])
+		self.bucket_offsets = np.concatenate(([0], self.bucket_sizes.cumsum()[:-1]))
+		self.airport_buckets = np.zeros(len(self.data['all_airports']), dtype=np.int32)
+		self.airport_buckets[self.bucket_members] = np.repeat(np.arange(len(self.buckets)), self.bucket_sizes)
+		
+	def breed(self, population, durations, count):
+		"""
+		Breed count children from the population. Each child is a crossover of two
+		parents (with probability GENETIC_CROSSOVER_RATE) or a copy of one, picked
+		by binary tournament, with one mutation: a waypoint swapped for another
+		airport of the same continent, either from its own geo hash bucket or 
+		from anywhere, or two continents swapped in the order. Hardcoded start 
+		airports and continents are never changed.
+		"""
+		rng = self.route_rng
+		rows = np.arange(count)
+		
+		def tournament():
+			a, b = rng.randint(len(population), size=(2, count))
+			return population[np.where(durations[a] <= durations[b], a, b)]
+			
+		children = tournament()
+		crossed = rng.random_sample(count) < GENETIC_CROSSOVER_RATE
+		children[crossed] = self.crossover(children[crossed], tournament()[crossed])
+		
+		# The first fixed_airports waypoints are hardcoded, and the continents of
+		# the first fixed_continents as well
+		fixed_airports = len(self.args.start_from_airport_ids)
+		fixed_continents = max(fixed_airports, len(self.args.start_from_continent_codes))
+		mutation = rng.random_sample(count)
+		if fixed_continents > 5:
+			mutation *= 1.0 - GENETIC_SWAP_RATE
+		
+		# Swap two continents
+		swap = rows[mutation >= 1.0 - GENETIC_SWAP_RATE]
+		i = rng.randint(fixed_continents, 7, size=len(swap))
+		j = rng.randint(fixed_continents, 6, size=len(swap))
+		j += j >= i
+		children[swap, i], children[swap, j] = children[swap, j], children[swap, i]
+		
+		# Swap a waypoint for a nearby airport, or any airport, on the same continent
+		change = rows[mutation < 1.0 - GENETIC_SWAP_RATE]
+		positions = rng.randint(fixed_airports, 7, size=len(change))
+		current = children[change, positions]
+		picks = rng.random_sample(len(change))
+		local = mutation[change] < GENETIC_LOCAL_RATE
+		buckets = self.airport_buckets[current]
+		continents = self.airport_continents[current]
+		replacements = np.where(local,
+			self.bucket_members[self.bucket_offsets[buckets] + (picks * self.bucket_sizes[buckets]).astype(np.int32)],
+			self.continent_members[self.continent_offsets[continents] + (picks * self.continent_sizes[continents]).astype(np.int32)])
+		# Buckets can straddle a continent boundary
+		replacements = np.where(self.airport_continents[replacements] == continents, replacements, current)
+		children[change, positions] = replacements
+		return children
+		
+	def crossover(self, first, second):
+		"""
+		Order crossover: each child keeps a random number of leading waypoints
+		from its first parent, and visits the remaining continents in the order
+		and at the airports of its second parent.
+		"""
+		count = len(first)
+		cuts = self.route_rng.randint(max(1, len(self.args.start_from_airport_ids)), 7, size=count)
+		prefix = np.arange(7) < cuts[:, np.newaxis]
+		first_continents = self.airport_continents[first]
+		second_continents = self.airport_continents[second]
+		visited = ((first_continents[:, :, np.newaxis] == second_continents[:, np.newaxis, :]) & prefix[:, :, np.newaxis]).any(axis=1)
+		# Positions in the second parent of the continents not visited yet, in order
+		order = np.argsort(visited, axis=1, kind='mergesort')
+		rows = np.arange(count)[:, np.newaxis]
+		rest = second[rows, order[rows, np.maximum(np.arange(7) - cuts[:, np.newaxis], 0)]]
+		return np.where(prefix, first, rest)
+		
+	def next_continents(self, step, visited):
+		"""Continents the waypoint at position step may be in, given those visited so far"""
+		if step < len(self.args.start_from_airport_ids):
+			options = [self.get_airport_by_id(self.args.start_from_airport_ids[step]).continent]
+		elif step < len(self.args.start_from_continent_codes):
+			options = [self.args.start_from_continent_codes[step]]
+		else:
+			options = self.data['airports_by_continent'].keys()
+		return [cont for cont in options if cont in self.data['airports_by_continent'] and cont not in visited]
+		
+	def restrict_to_start_airport(self, step, indices, cost):
+		"""Only allow the hardcoded airport, if there is one for this step"""
+		if step < len(self.args.start_from_airport_ids):
+			fixed = self.get_airport_by_id(self.args.start_from_airport_ids[step]).index
+			cost = np.where(indices == fixed, cost, np.inf)
+		return cost
+		
+	def get_segment_block(self, seg_num, src_indices, dst_indices):
+		"""
+		Durations from each of src_indices to each of dst_indices for the plane
+		flying segment seg_num, with segments that are out of range set to inf.
+		"""
+		plane = get_plane(seg_num)
+		block = np.ix_(src_indices, dst_indices)
+		durations = self.data['duration_cache'][plane['avg_speed_mph']][block].astype(np.float64)
+		lengths = self.data['dist_cache'][block] * (1.0 + self.args.routing_overhead_pct / 100.0)
+		durations[lengths >= plane['max_range_mi']] = np.inf
+		return durations
+		
+	def solve_dp(self):
+		"""
+		Held-Karp style dynamic program over the current representatives. The state
+		is (visited continents, current airport), and each state holds the shortest
+		duration of any valid partial route reaching it, so every continent ordering
+		and airport choice is covered without enumerating routes. Plane range and
+		the start airport / continent constraints are applied the same way as in
+		search_random.
+		
+		Returns the optimal route ending at each airport of the final continent
+		(best first, at most num_best_routes), and the number of segments scored.
+		"""
+		airports_by_continent = self.data['airports_by_continent']
+		continents = sorted(airports_by_continent.keys())
+		if len(continents) < 7:
+			return [], 0
+		bits = dict((cont, 1 << i) for i, cont in enumerate(continents))
+		indices = dict((cont, np.array([airport.index for airport in airports_by_continent[cont]])) for cont in continents)
+		
+		def visited(mask):
+			return set(cont for cont in continents if mask & bits[cont])
+		
+		# layer maps (mask, continent) to the best cost of reaching each airport in
+		# that continent, back maps it to the previous continent / airport position
+		layer = {}
+		back = {}
+		for cont in self.next_continents(0, set()):
+			layer[(bits[cont], cont)] = self.restrict_to_start_airport(0, indices[cont], np.zeros(len(indices[cont])))
+		search_count = 0
+		for step in range(1, 7):
+			next_layer = {}
+			for (mask, cont), cost in layer.items():
+				for next_cont in self.next_continents(step, visited(mask)):
+					total = cost[:, np.newaxis] + self.get_segment_block(step, indices[cont], indices[next_cont])
+					search_count += total.size
+					best_pos = total.argmin(axis=0)
+					best = self.restrict_to_start_airport(step, indices[next_cont], total[best_pos, np.arange(total.shape[1])])
+					key = (mask | bits[next_cont], next_cont)
+					if key not in next_layer:
+						next_layer[key] = best
+						back[key] = (np.empty(len(best), dtype=np.int32), best_pos)
+						back[key][0].fill(continents.index(cont))
+					else:
+						improved = best < next_layer[key]
+						next_layer[key][improved] = best[improved]
+						back[key][0][improved] = continents.index(cont)
+						back[key][1][improved] = best_pos[improved]
+			layer = next_layer
+		
+		# Collect the best route ending at each airport and walk back through the states
+		ends = []
+		for (mask, cont), cost in layer.items():
+			for pos in np.flatnonzero(np.isfinite(cost)):
+				ends.append((cost[pos], mask, cont, pos))
+		ends.sort()
 		routes = []
-		keys = []
-		for route in best_routes:
-			if repr(route) not in keys:
-				routes.append(route)
-				keys.append(repr(route))
-		best_routes = routes
+		for cost, mask, cont, pos in ends[:self.args.num_best_routes]:
+			waypoints = []
+			while True:
+				waypoints.append(airports_by_continent[cont][pos])
+				if (mask, cont) not in back:
+					break
+				prev_cont, prev_pos = back[(mask, cont)]
+				mask, cont, pos = mask ^ bits[cont], continents[prev_cont[pos]], prev_pos[pos]
+			routes.append(Route([airport.index for airport in waypoints[::-1]], self.data['all_airports']))
+		return routes, search_count
+		
+	def solve_beam(self):
+		"""
+		Beam search over the current representatives. Partial routes are grown one
+		continent at a time, and after each step only the beam_width partial routes
+		with the lowest duration so far plus a lower bound on the rest are kept.
+		
+		The lower bound is, for each continent still to be visited, the shortest
+		segment by any plane from any other continent into it. Every route has to 
+		fly into each of those continents once, so the bound never overestimates.
+		When several partial routes visit the same continents and end at the same
+		airport, only the fastest is kept, since the others can't finish faster.
+		
+		Returns the best complete routes (at most num_best_routes), and the number
+		of segments scored.
+		"""
+		airports_by_continent = self.data['airports_by_continent']
+		continents = sorted(airports_by_continent.keys())
+		if len(continents) < 7:
+			return [], 0
+		bits = dict((cont, 1 << i) for i, cont in enumerate(continents))
+		indices = dict((cont, np.array([airport.index for airport in airports_by_continent[cont]])) for cont in continents)
+		airports_by_index = dict((airport.index, airport) for airport in self.data['airports'])
+		
+		min_entry = {}
+		for cont in continents:
+			sources = np.concatenate([indices[other] for other in continents if other != cont])
+			min_entry[cont] = min(self.get_segment_block(seg_num, sources, indices[cont]).min() for seg_num in range(1, 7))
+		
+		def lower_bound(mask):
+			return sum(min_entry[cont] for cont in continents if not mask & bits[cont])
+		
+		# Each partial route is (duration, visited mask, airport indices)
+		beam = []
+		for cont in self.next_continents(0, set()):
+			cost = self.restrict_to_start_airport(0, indices[cont], np.zeros(len(indices[cont])))
+			beam.extend((0.0, bits[cont], [index]) for index in indices[cont][np.isfinite(cost)])
+		search_count = 0
+		for step in range(1, 7):
+			# Group partial routes by visited continents and current continent so
+			# that each group can be extended with one block of the duration matrix
+			groups = {}
+			for i, (cost, mask, path) in enumerate(beam):
+				groups.setdefault((mask, airports_by_index[path[-1]].continent), []).append(i)
+			parents, targets, masks, costs = [], [], [], []
+			for (mask, cont), members in groups.items():
+				members = np.array(members)
+				last = np.array([beam[i][2][-1] for i in members])
+				cost = np.array([beam[i][0] for i in members])
+				visited = set(c for c in continents if mask & bits[c])
+				for next_cont in self.next_continents(step, visited):
+					total = cost[:, np.newaxis] + self.get_segment_block(step, last, indices[next_cont])
+					total = self.restrict_to_start_airport(step, indices[next_cont][np.newaxis, :], total)
+					search_count += total.size
+					rows, cols = np.nonzero(np.isfinite(total))
+					parents.append(members[rows])
+					targets.append(indices[next_cont][cols])
+					costs.append(total[rows, cols])
+					masks.append(np.repeat(mask | bits[next_cont], len(rows)))
+			if len(costs) == 0:
+				return [], search_count
+			parents, targets = np.concatenate(parents), np.concatenate(targets)
+			masks, costs = np.concatenate(masks), np.concatenate(costs)
+			bounds = dict((mask, lower_bound(mask)) for mask in np.unique(masks))
+			scores = costs + np.array([bounds[mask] for mask in masks])
+			order = np.argsort(scores, kind='mergesort')
+			# Keep the fastest partial route for each (visited, airport) state
+			keys = masks[order].astype(np.int64) * len(self.data['all_airports']) + targets[order]
+			unique_keys, first = np.unique(keys, return_index=True)
+			keep = order[np.sort(first)][:self.args.beam_width]
+			beam = [(costs[i], masks[i], beam[parents[i]][2] + [targets[i]]) for i in keep]
+		
+		beam.sort(key=lambda x: x[0])
+		all_airports = self.data['all_airports']
+		routes = [Route(path, all_airports) for cost, mask, path in beam[:self.args.num_best_routes]]
+		return routes, search_count
+		
+	def run_search(self):
+		"""Run the search selected by args, returns (best_routes, search_count, valid_route_count)"""
+		self.deadline = time.time() + self.args.time_budget if self.args.time_budget else None
+		if self.args.solver == 'dp':
+			return self.search_shuffles(self.solve_dp)
+		elif self.args.solver == 'beam':
+			return self.search_shuffles(self.solve_beam)
+		elif self.args.solver == 'genetic':
+			return self.search_genetic()
+		elif self.args.workers > 1:
+			return self.search_parallel()
+		else:
+			return self.search_random(checkpoint_file=self.args.checkpoint_file)
+		
+	def run(self):
+		start_time = time.time()
+		with metrics.timer('search'):
+			if self.args.profile:
+				profiler = cProfile.Profile()
+				best_routes, search_count, valid_route_count = profiler.runcall(self.run_search)
+				profiler.dump_stats(self.args.profile)
+				print "Wrote search profile to %s" % self.args.profile
+				pstats.Stats(profiler).sort_stats('cumulative').print_stats(PROFILE_PRINT_LINES)
+			else:
+				best_routes, search_count, valid_route_count = self.run_search()
+		
+		elapsed_time = time.time() - start_time
 	
 		if not self.args.disable_optimization:
 			print "Finished initial search in %.2fs, optimizing..." % elapsed_time
@@ -495,13 +1735,18 @@ class Search(object):
 			optimize_count = 0
 			for route in best_routes:
 				print "Optimizing %s" % route
-				best_route, count = self.optimize_route(route, self.args.optimization_radius_mi, self.args.optimization_max_searches)
+				if self.args.optimizer == 'local':
+					best_route, count = self.improve_route(route, self.args.optimization_radius_mi)
+				else:
+					best_route, count = self.optimize_route(route, self.args.optimization_radius_mi, self.args.optimization_max_searches)
 				optimized_routes.append(best_route)
 				optimize_count += count
-				old_dur = route.get_duration(data, args)
-				new_dur = best_route.get_duration(data, args)
+				old_dur = route.get_duration(self.data, self.args)
+				new_dur = best_route.get_duration(self.data, self.args)
 				delta = (old_dur - new_dur) / old_dur * 100.0
 				print "\tReduced route from %.2f to %.2f hrs after searching %s additional routes (%.2f%%)" % (old_dur, new_dur, count, delta)
+				metrics.count('optimize_evaluated', count)
+				metrics.emit('optimized', route=repr(best_route), old_duration_hrs=old_dur, new_duration_hrs=new_dur, evaluated=count)
 			optimized_routes = self.sort_routes(optimized_routes)
 		else:
 			optimize_count = 0
@@ -518,6 +1763,75 @@ class Search(object):
 		}
 		return results
 	
+def random_search_worker(job):
+	"""Entry point for search_parallel's worker processes"""
+	seed, max_searches, checkpoint_file = job
+	search = search_worker_state
+	# The parent writes the metrics, workers only send back their counters
+	metrics.detach()
+	metrics.counters.clear()
+	search.seed(seed)
+	search.setup_search()
+	best_routes, search_count, valid_route_count = search.search_random(max_searches, checkpoint_file)
+	paths = [route.indices.tolist() for route in best_routes]
+	return paths, search_count, valid_route_count, dict(metrics.counters)
+	
+def derive_seed(seed, stream):
+	"""Seed for one of the independent RNG streams of a run (see Search.seed)"""
+	return int(hashlib.sha1('%s:%s' % (seed, stream)).hexdigest()[:8], 16)
+	
+def checkpoint_key(data, args):
+	"""
+	Hash of the airports and every setting that a checkpointed search depends 
+	on. Settings that only decide how long the search runs (--max-searches, 
+	--time-budget etc.) or what happens after it are left out, so a search can
+	be resumed with a larger --max-searches to extend it.
+	"""
+	settings = [
+		args.solver,
+		args.workers,
+		args.geo_hash_resolution_deg,
+		args.geo_hash_budget,
+		args.routing_overhead_pct,
+		args.disable_jet_stream_correction,
+		args.jet_stream_correction_mph,
+		args.start_from_airport_ids,
+		args.start_from_continent_codes,
+	]
+	sha = hashlib.sha1(repr(settings))
+	sha.update(airport_ids_hash(np.array([airport.id for airport in data['all_airports']])))
+	return sha.digest()
+	
+def read_checkpoint(filepath, key):
+	"""
+	A checkpoint is a header (magic, version, key) followed by a pickle of the
+	search state (see Search.save_checkpoint). Returns None if it's missing, 
+	and raises ValueError if it's from a different search.
+	"""
+	try:
+		checkpointfile = open(filepath, 'rb')
+	except IOError:
+		return None
+	with checkpointfile:
+		header = checkpointfile.read(CHECKPOINT_HEADER.size)
+		if len(header) < CHECKPOINT_HEADER.size:
+			raise ValueError("Checkpoint %s is truncated" % filepath)
+		magic, version, checkpoint_key = CHECKPOINT_HEADER.unpack(header)
+		if magic != CHECKPOINT_MAGIC or version != CHECKPOINT_VERSION:
+			raise ValueError("%s is not a checkpoint" % filepath)
+		if checkpoint_key != key:
+			raise ValueError("Checkpoint %s is from a search with different airports or settings" % filepath)
+		return cPickle.load(checkpointfile)
+	
+def write_checkpoint(filepath, key, state):
+	# Written to a temporary file first, so an interrupted write never replaces
+	# the previous checkpoint with a partial one
+	tmp_filepath = filepath + '.tmp'
+	with open(tmp_filepath, 'wb') as checkpointfile:
+		checkpointfile.write(CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION, key))
+		cPickle.dump(state, checkpointfile, cPickle.HIGHEST_PROTOCOL)
+	os.rename(tmp_filepath, filepath)
+	
 def arg_summary(args):
 	out = "Using args:\r\n"
 	for k, v in vars(args).items():
@@ -529,24 +1843,27 @@ def arg_summary(args):
 			out += "\t%s: %s\r\n" % (k, v)
 	return out
 		
+@metrics.timed('generate_report')
 def generate_report(data, args, results):
 	
+	type_masks = {}
+	
 	def get_nearest_airport(airport, kind, radius=1000):
 		"""
 		For cases when the ideal airport is small, look up the closest airport within 
 		a certain radius that may larger or have more services. Radius is in miles.
 		"""
-		best = (999999, None)
-		for candidate in data['airports']:
-			if airport['ident'] == candidate['ident']:
-				continue
-			dist = get_dist_from_cache(data['dist_cache'], airport, candidate)
-			if dist < radius and dist < best[0] and candidate['type'] == kind:
-				best = (dist, candidate)
-		return best
+		if kind not in type_masks:
+			type_masks[kind] = data['types'] == kind
+		indices, dists = data['spatial_index'].query_nearest(
+			airport.latitude, airport.longitude, k=2, mask=type_masks[kind], max_dist_mi=radius)
+		for index, dist in zip(indices, dists):
+			if index != airport.index:
+				return (dist, data['all_airports'][index])
+		return (999999, None)
 		
-	def link_for_airport(airport):
-		return airport['home_link'] or airport['wikipedia_link'] or 'https://www.google.com/search?q=%s+airport' % airport['ident']
+	def link_for_airport(details):
+		return details['home_link'] or details['wikipedia_link'] or 'https://www.google.com/search?q=%s+airport' % details['ident']
 		
 	out = "<html><body>"
 	out += "<pre>"
@@ -573,19 +1890,21 @@ def generate_report(data, args, results):
 				seg_length = route.get_segment_length(last_airport, airport, data, args)
 				seg_speed, seg_duration = route.get_segment_duration(plane, last_airport, airport, data, args)
 			last_airport = airport
-			out += "<a href=\"%s\">%s</a> %s %s " % (link_for_airport(airport), airport['ident'], airport['continent'], airport['iso_country'])
+			details = airport.details
+			out += "<a href=\"%s\">%s</a> %s %s " % (link_for_airport(details), airport.ident, airport.continent, details['iso_country'])
 			out += "(%.00f mi / %.1f hrs / %i mph)<br>" % (seg_length, seg_duration, seg_speed)
-			out += "\tname: <a href=\"%s\">%s</a>\r\n" % (link_for_airport(airport), airport.get('name') or 'n/a')
-			out += "\tcountry: %s\r\n" % (airport.get('country_name') or 'n/a')
-			out += "\televation: %sft\r\n" % (airport.get('elevation_ft') or 'n/a')
-			out += "\ttype: %s\r\n" % (airport.get('type') or 'n/a')
+			out += "\tname: <a href=\"%s\">%s</a>\r\n" % (link_for_airport(details), details.get('name') or 'n/a')
+			out += "\tcountry: %s\r\n" % (details.get('country_name') or 'n/a')
+			out += "\televation: %sft\r\n" % (details.get('elevation_ft') or 'n/a')
+			out += "\ttype: %s\r\n" % (airport.type or 'n/a')
 			out += "\tplane: %s\r\n" % plane.get('short_name', 'n/a')
-			if airport['type'] != "large_airport":
+			if airport.type != "large_airport":
 				for kind in ["medium_airport", "large_airport"]:
 					dist, alternate = get_nearest_airport(airport, kind)
 					if alternate:
-						out += "\tnearest alternate %s: <a href=\"%s\">%s</a>, %.2f mi\r\n" % (kind, link_for_airport(alternate), alternate['ident'], dist)
-						out += "\t\t<a href=\"%s\">%s</a>, %s\r\n" % (link_for_airport(alternate), alternate['name'], alternate['iso_country'])
+						alternate_details = alternate.details
+						out += "\tnearest alternate %s: <a href=\"%s\">%s</a>, %.2f mi\r\n" % (kind, link_for_airport(alternate_details), alternate.ident, dist)
+						out += "\t\t<a href=\"%s\">%s</a>, %s\r\n" % (link_for_airport(alternate_details), alternate_details['name'], alternate_details['iso_country'])
 					else:
 						out += "\tnearest alternate %s: None\r\n" % kind
 		out += "Total Distance: %.2f miles\r\n" % route.get_length(data, args)
@@ -593,12 +1912,21 @@ def generate_report(data, args, results):
 	out += "</pre></body></html>"
 	return out
 	
-if __name__ == "__main__":
+def parse_args(argv=None):
 	parser = argparse.ArgumentParser(description='Seven Continents Marathon Challenge route solver')
 
 	parser.add_argument('--max-searches', action="store", 
 						default=10000000, type=int,
 						help="Maximum number of routes to search before terminating.")
+	parser.add_argument('--time-budget', action="store",
+						default=0, type=float,
+						help="Stop searching after this many seconds and go on to optimization (default is no limit).")
+	parser.add_argument('--convergence-searches', action="store",
+						default=0, type=int,
+						help="Stop searching once the best route hasn't improved by more than --convergence-pct over this many searches (default is to never stop early).")
+	parser.add_argument('--convergence-pct', action="store",
+						default=0.1, type=float,
+						help="Minimum improvement in percent for --convergence-searches.")
 	parser.add_argument('--routing-overhead-pct', action="store", 
 						default=10, type=int,
 						help="Overhead percentage (as a decimal) that should be added to route length to account for routing inefficiencies.")
@@ -629,6 +1957,9 @@ if __name__ == "__main__":
 	parser.add_argument('--geo-hash-resolution_deg', action="store",
 						default=5.0, type=float,
 						help="Reduce search space by consolidating airports within geo_hash_resolution_deg degrees of lat/long into a single airport.")
+	parser.add_argument('--geo-hash-budget', action="store",
+						default=0, type=int,
+						help="Instead of a fixed degree grid, split each continent into at most this many variable-size cells, keeping one airport per cell (default is 0, use geo_hash_resolution_deg).")
 	parser.add_argument('--geo-hash-shuffles', action="store",
 						default=10, type=int,
 						help="Number of times to reshuffle the airport selected within each geo hash bucket during the search.")
@@ -638,36 +1969,78 @@ if __name__ == "__main__":
 	parser.add_argument('--optimization-max-searches', action="store",
 						default=250000, type=int,
 						help="Maximum number of searches to complete during each route optimization.")
+	parser.add_argument('--optimizer', action="store",
+						default="local", choices=['local', 'sample'],
+						help="Optimization pass: 'local' runs a local search over alternates and continent order, 'sample' scores random combinations of alternates (default is 'local').")
 	parser.add_argument('--html-file', action="store",
 						default="report.html",
 						help="Output report file (default is 'report.html').")
 	parser.add_argument('--data-path', action="store",
 						default="data/",
 						help="Path to CSV files (default is 'data/').")
+	parser.add_argument('--solver', action="store",
+						default="random", choices=['random', 'dp', 'beam', 'genetic'],
+						help="Search strategy: 'random' samples routes, 'dp' solves exactly for the geo hash representatives, 'beam' runs a beam search over them, 'genetic' evolves a population of routes (default is 'random').")
+	parser.add_argument('--workers', action="store",
+						default=1, type=int,
+						help="Number of processes to run the random search in.")
+	parser.add_argument('--beam-width', action="store",
+						default=1000, type=int,
+						help="Number of partial routes kept at each step of the beam search.")
+	parser.add_argument('--population-size', action="store",
+						default=2048, type=int,
+						help="Number of routes kept in each generation of the genetic search.")
+	parser.add_argument('--cache-workers', action="store",
+						default=0, type=int,
+						help="Number of processes used to build the distance cache (default is one per core).")
+	parser.add_argument('--seed', action="store",
+						default=None, type=int,
+						help="Seed for the random search, so that a run can be reproduced exactly (default is a random seed, shown in the arg summary).")
+	parser.add_argument('--metrics-file', action="store",
+						default=None,
+						help="Write timers, counters and search progress to this file as JSON lines.")
+	parser.add_argument('--checkpoint-file', action="store",
+						default=None,
+						help="Save the state of the search to this file periodically and when it ends, so that it can be continued with --resume (one file per worker when using --workers).")
+	parser.add_argument('--checkpoint-interval', action="store",
+						default=60.0, type=float,
+						help="Seconds between checkpoints.")
+	parser.add_argument('--resume', action='store_true', default=False,
+						help="Continue the search saved in --checkpoint-file, if there is one, instead of starting a new one. A finished search can be extended by resuming it with a larger --max-searches.")
+	parser.add_argument('--profile', action="store",
+						default=None,
+						help="Profile the search with cProfile and write the stats to this file (only the main process is profiled when using --workers).")
 
-	args = parser.parse_args()
+	args = parser.parse_args(argv)
+	if args.resume and not args.checkpoint_file:
+		parser.error("--resume requires --checkpoint-file")
 	
 	# Pre-processing for certain arguments
 	args.start_from_airport_ids = [int(i) for i in args.start_from_airport_ids.split(',') if i]
 	args.start_from_airport_codes = [code.strip() for code in args.start_from_airport_codes.split(',') if code]
 	args.start_from_continent_codes = args.start_from_continent_codes.split(',')			
+	if args.seed is None:
+		args.seed = random.randrange(2 ** 31)
+	return args
 	
+if __name__ == "__main__":
+	args = parse_args()
 	print arg_summary(args)
+	if args.metrics_file:
+		metrics.open_stream(args.metrics_file)
+		metrics.emit('args', **dict((k, v) for k, v in vars(args).items()))
 	
 	# Load data from config files and process blacklists
 	data = load_data(args)
 	
 	# Convert codes to ids
-	if len(args.start_from_airport_codes) > 0:
-		args.start_from_airport_ids = []
-		for code in args.start_from_airport_codes:
-			for airport in data['all_airports']:
-				if airport['ident'] == code:
-					args.start_from_airport_ids.append(airport['id'])
+	resolve_airport_codes(data, args)
 	print "start_from_airport_ids: %s" % args.start_from_airport_ids
 	
 	# Generate distance cache, if needed
-	generate_dist_cache(args.data_path.rstrip('/'), data['all_airports'])
+	generate_dist_cache(args.data_path.rstrip('/'), data['all_airports'], args)
+	data['dist_cache'] = load_dist_cache(args.data_path.rstrip('/'), data['all_airports'], args)
+	data['duration_cache'] = generate_duration_cache(data, args)
 			
 	# Run search until max_searches reached or terminated
 	search = Search(data, args)
@@ -681,3 +2054,4 @@ if __name__ == "__main__":
 		print "Report written to %s" % args.html_file
 	except:
 		print "Could not generate html file %s" % args.html_file
+	metrics.close()
@@ -0,0 +1,132 @@
+# Spatial index for airports, used for the radius and nearest airport queries
+# in the optimizer and the report. Airports are stored as 3D unit vectors in a
+# KD-tree, which avoids any special cases around the poles or the date line.
+# The straight line (chord) distance between two unit vectors maps one-to-one
+# onto great circle distance, so queries are done on chords and converted.
+
+import heapq
+
+import numpy as np
+
+class SpatialIndex(object):
+
+	def __init__(self, lats, longs, earth_radius_mi, leaf_size=16):
+		"""Build the tree from arrays of latitudes and longitudes, in degrees"""
+		self.earth_radius_mi = earth_radius_mi
+		self.leaf_size = leaf_size
+		self.points = to_unit_vectors(np.asarray(lats, dtype=np.float64), np.asarray(longs, dtype=np.float64))
+		self.order = np.arange(len(self.points))
+		# Nodes are stored in flat lists: point range (into self.order), bounding
+		# box, and child node ids (-1 for leaves)
+		self.starts, self.stops = [], []
+		self.mins, self.maxs = [], []
+		self.lefts, self.rights = [], []
+		if len(self.points) > 0:
+			self.build(0, len(self.points))
+
+	def __len__(self):
+		return len(self.points)
+
+	def build(self, start, stop):
+		node = len(self.starts)
+		points = self.points[self.order[start:stop]]
+		self.starts.append(start)
+		self.stops.append(stop)
+		self.mins.append(points.min(axis=0))
+		self.maxs.append(points.max(axis=0))
+		self.lefts.append(-1)
+		self.rights.append(-1)
+		if stop - start > self.leaf_size:
+			# Split along the widest dimension at the median
+			dim = (self.maxs[node] - self.mins[node]).argmax()
+			mid = (stop - start) // 2
+			self.order[start:stop] = self.order[start:stop][np.argsort(points[:, dim], kind='mergesort')]
+			self.lefts[node] = self.build(start, start + mid)
+			self.rights[node] = self.build(start + mid, stop)
+		return node
+
+	def box_dist(self, node, point):
+		"""Lower bound on the chord distance from point to anything in node"""
+		delta = np.maximum(self.mins[node] - point, 0.0) + np.maximum(point - self.maxs[node], 0.0)
+		return np.sqrt((delta * delta).sum())
+
+	def leaf_query(self, node, point, mask):
+		indices = self.order[self.starts[node]:self.stops[node]]
+		if mask is not None:
+			indices = indices[mask[indices]]
+		delta = self.points[indices] - point
+		return indices, np.sqrt((delta * delta).sum(axis=1))
+
+	def to_chord(self, dist_mi):
+		return 2.0 * np.sin(min(dist_mi / self.earth_radius_mi, np.pi) / 2.0)
+
+	def to_dist(self, chord):
+		return 2.0 * self.earth_radius_mi * np.arcsin(np.minimum(chord / 2.0, 1.0))
+
+	def query_radius(self, lat, long, radius_mi, mask=None):
+		"""
+		Indices of points within radius_mi miles of (lat, long), and their great
+		circle distances, nearest first. If mask is given, only points where it is
+		True are returned.
+		"""
+		if len(self) == 0:
+			return np.array([], dtype=int), np.array([])
+		point = to_unit_vectors(np.array([lat]), np.array([long]))[0]
+		max_chord = self.to_chord(radius_mi)
+		found, chords = [], []
+		stack = [0]
+		while stack:
+			node = stack.pop()
+			if self.box_dist(node, point) > max_chord:
+				continue
+			if self.lefts[node] < 0:
+				indices, dists = self.leaf_query(node, point, mask)
+				inside = dists <= max_chord
+				found.append(indices[inside])
+				chords.append(dists[inside])
+			else:
+				stack.append(self.lefts[node])
+				stack.append(self.rights[node])
+		if not found:
+			return np.array([], dtype=int), np.array([])
+		found, chords = np.concatenate(found), np.concatenate(chords)
+		order = np.argsort(chords, kind='mergesort')
+		return found[order], self.to_dist(chords[order])
+
+	def query_nearest(self, lat, long, k=1, mask=None, max_dist_mi=None):
+		"""
+		Indices of the k points nearest to (lat, long), and their great circle
+		distances, nearest first. Optionally limited to points where mask is True
+		and to points within max_dist_mi miles.
+		"""
+		if len(self) == 0:
+			return np.array([], dtype=int), np.array([])
+		point = to_unit_vectors(np.array([lat]), np.array([long]))[0]
+		max_chord = np.inf if max_dist_mi is None else self.to_chord(max_dist_mi)
+		# best is a max-heap of (-chord, index) holding the k nearest so far
+		best = []
+		nodes = [(self.box_dist(0, point), 0)]
+		while nodes:
+			box_dist, node = heapq.heappop(nodes)
+			if box_dist > max_chord or (len(best) == k and box_dist > -best[0][0]):
+				break
+			if self.lefts[node] < 0:
+				indices, dists = self.leaf_query(node, point, mask)
+				for index, dist in zip(indices, dists):
+					if dist > max_chord:
+						continue
+					if len(best) < k:
+						heapq.heappush(best, (-dist, index))
+					elif dist < -best[0][0]:
+						heapq.heapreplace(best, (-dist, index))
+			else:
+				for child in (self.lefts[node], self.rights[node]):
+					heapq.heappush(nodes, (self.box_dist(child, point), child))
+		best.sort(reverse=True)
+		indices = np.array([index for chord, index in best], dtype=int)
+		chords = np.array([-chord for chord, index in best])
+		return indices, self.to_dist(chords)
+
+def to_unit_vectors(lats, longs):
+	lats, longs = np.radians(lats), np.radians(longs)
+	return np.column_stack((np.cos(lats) * np.cos(longs), np.cos(lats) * np.sin(longs), np.sin(lats)))